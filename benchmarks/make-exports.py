@@ -0,0 +1,130 @@
+import csv
+import argparse
+import os
+import random
+
+# Generate synthetic Canvas exports for trying the scripts at scale.
+# Writes into outDir:
+#  Mastery.csv: learning mastery export, headers "Gk: Group > Code: Title result"
+#    and "... mastery points" for every outcome, in the chosen order
+#  Grades.csv: gradebook export with the Points Possible row, logins and sections
+#  OutcomeList.txt: every outcome with its LaTeX stem and week introduced
+#  Quiz.tex: a small quiz template with one \obj command per outcome
+# The same seed always gives the same files.
+
+parser = argparse.ArgumentParser(description='Generate synthetic Canvas gradebook and mastery exports.')
+parser.add_argument('--outDir', default='.', help='folder path, where the generated files are written')
+parser.add_argument('--students', type=int, default=100, help='integer, number of students')
+parser.add_argument('--groups', type=int, default=4, help='integer, number of outcome groups')
+parser.add_argument('--outcomesPerGroup', type=int, default=6, help='integer, number of outcomes in each group')
+parser.add_argument('--blank', type=float, default=0.3, help='number, fraction of mastery cells left blank (not yet assessed)')
+parser.add_argument('--order', default='random', choices=['random', 'sorted', 'reversed'], help='text, order of the outcome columns in the mastery export')
+parser.add_argument('--sections', type=int, default=2, help='integer, number of sections')
+parser.add_argument('--weeks', type=int, default=14, help='integer, outcomes are introduced over this many weeks')
+parser.add_argument('--seed', type=int, default=0, help='integer, random seed')
+args = parser.parse_args()
+
+firstNames = ['Avery', 'Blake', 'Casey', 'Dana', 'Eli', 'Finley', 'Gray', 'Harper', 'Indy', 'Jordan',
+              'Kai', 'Logan', 'Morgan', 'Noor', 'Oakley', 'Parker', 'Quinn', 'Riley', 'Sage', 'Taylor']
+lastNames = ['Adams', 'Baker', 'Carter', 'Diaz', 'Evans', 'Foster', 'Garcia', 'Hughes', 'Ito', 'Jensen',
+             'Kim', 'Lopez', 'Moore', 'Nguyen', 'Ortiz', 'Patel', 'Quist', 'Reed', 'Silva', 'Turner',
+             'Underwood', 'Vance', 'Walsh', 'Xu', 'Young', 'Zimmer']
+groupTitles = ['Prerequisites', 'Functions', 'Limits', 'Derivatives', 'Applications', 'Integrals',
+               'Sequences', 'Series', 'Vectors', 'Matrices']
+outcomeTitles = ['Definitions', 'Evaluation', 'Graphs', 'Algebra', 'Estimation', 'Rules', 'Modeling',
+                 'Interpretation', 'Approximation', 'Proof']
+
+def letters(k):
+    # 0 -> A, 25 -> Z, 26 -> AA, ... (LaTeX command names only allow letters)
+    text = ''
+    k = k + 1
+    while k > 0:
+        k, r = divmod(k-1, 26)
+        text = chr(ord('A') + r) + text
+    return text
+
+def roman(n):
+    numerals = [(1000, 'M'), (900, 'CM'), (500, 'D'), (400, 'CD'), (100, 'C'), (90, 'XC'),
+                (50, 'L'), (40, 'XL'), (10, 'X'), (9, 'IX'), (5, 'V'), (4, 'IV'), (1, 'I')]
+    text = ''
+    for value, numeral in numerals:
+        while n >= value:
+            text = text + numeral
+            n = n - value
+    return text
+
+def studentName(i):
+    first = firstNames[i % len(firstNames)]
+    last = lastNames[(i // len(firstNames)) % len(lastNames)]
+    repeat = i // (len(firstNames) * len(lastNames))
+    if repeat > 0:
+        last = last + letters(repeat-1).lower()
+    return first + ' ' + last
+
+random.seed(args.seed)
+os.makedirs(args.outDir, exist_ok=True)
+
+# Every outcome: (group code, group title, outcome code, outcome title, stem, week)
+outcomes = []
+numOutcomes = args.groups * args.outcomesPerGroup
+for g in range(args.groups):
+    groupLetter = letters(g)
+    groupTitle = groupTitles[g % len(groupTitles)]
+    for k in range(args.outcomesPerGroup):
+        outcomeTitle = outcomeTitles[k % len(outcomeTitles)] + ' ' + str(k+1)
+        week = 1 + (len(outcomes) * args.weeks) // numOutcomes
+        outcomes.append(('G%d' % g, groupTitle, '%s%d' % (groupLetter, k+1), outcomeTitle,
+                         groupLetter + roman(k+1), week))
+
+columnOrder = list(range(numOutcomes))
+if args.order == 'random':
+    random.shuffle(columnOrder)
+elif args.order == 'reversed':
+    columnOrder.reverse()
+
+with open(os.path.join(args.outDir, 'OutcomeList.txt'), 'w') as outcomeFile:
+    for groupCode, groupTitle, outcomeCode, outcomeTitle, stem, week in outcomes:
+        outcomeFile.write('\t'.join([groupCode, outcomeCode, stem, str(week)]) + '\n')
+
+with open(os.path.join(args.outDir, 'Mastery.csv'), 'w', newline='') as masteryFile:
+    masteryStream = csv.writer(masteryFile)
+    headers = ['Student name', 'Student ID']
+    for k in columnOrder:
+        groupCode, groupTitle, outcomeCode, outcomeTitle, stem, week = outcomes[k]
+        title = '%s: %s > %s: %s' % (groupCode, groupTitle, outcomeCode, outcomeTitle)
+        headers = headers + [title + ' result', title + ' mastery points']
+    masteryStream.writerow(headers)
+    for i in range(args.students):
+        row = [studentName(i), str(100000 + i)]
+        for k in columnOrder:
+            required = '1' if outcomes[k][5] > args.weeks - 2 else '2'
+            if random.random() < args.blank:
+                score = ''
+            else:
+                score = str(random.choice([0, 1, 2, 2, 3, 3, 3, 4]))
+            row = row + [score, required]
+        masteryStream.writerow(row)
+
+with open(os.path.join(args.outDir, 'Grades.csv'), 'w', newline='') as gradesFile:
+    gradesStream = csv.writer(gradesFile)
+    gradesStream.writerow(['Student', 'ID', 'SIS User ID', 'SIS Login ID', 'Section',
+                           '1st Assessment', 'Current Score', 'Final Score'])
+    gradesStream.writerow(['    Points Possible', '', '', '', '', '1', '(read only)', '(read only)'])
+    for i in range(args.students):
+        name = studentName(i)
+        login = name.lower().replace(' ', '.') + str(i)
+        section = 'SECTION%d' % (1 + i % max(1, args.sections))
+        gradesStream.writerow([name, str(100000 + i), login, login, section,
+                               '1', '100.00', '100.00'])
+
+with open(os.path.join(args.outDir, 'Quiz.tex'), 'w') as quizFile:
+    quizFile.write('\\documentclass[11pt, oneside]{article}\n')
+    quizFile.write('\\setlength{\\parindent}{0in}\n\n')
+    quizFile.write('\\newcommand{\\header}{\n    \\centerline{\\textbf{Synthetic} Learning Mastery Set}\n}\n\n')
+    quizFile.write('\\newcommand{\\objMastery}[1]{\n\\item [\\textbf{Progress.}] You have already mastered \\textit{#1}.\n}\n\n')
+    for groupCode, groupTitle, outcomeCode, outcomeTitle, stem, week in outcomes:
+        quizFile.write('\\newcommand{\\obj%s}[1]{\n    \\item [\\textbf{%s.}#1] Problem about %s.\n\n}\n\n'
+                       % (stem, outcomeCode, outcomeTitle))
+    quizFile.write('\\begin{document}\n\n\\pagestyle{myheadings}\n\\raggedbottom\n\n\\include{Questions}\n\n\\end{document}\n')
+
+print('Wrote %d students and %d outcomes to %s' % (args.students, numOutcomes, args.outDir))
@@ -0,0 +1,208 @@
+import csv
+import argparse
+import json
+import os
+import platform
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Time the mastery scripts on synthetic exports (see make-exports.py) for a
+# range of class sizes, and write the results to a JSON file so that runs
+# from different commits can be compared (--baseline).
+#
+# Stages:
+#  header: read the mastery export header and split every outcome title
+#  rows: read every row into a ScoreMatrix and work out mastery
+#  summary: progress-reports.py --summary (parsing and report rendering)
+#  stats: progress-reports.py --stats
+#  quizTeX: mastery-quizzes.py writing every Questions.tex, with pdflatex
+#    replaced by a stub that does nothing (unless --realLatex). With the
+#    stub, the quizzes are written as one --combined document, so the time
+#    is the TeX generation rather than starting a stub for every student;
+#    the combined compile then fails on purpose, as the stub writes no PDF.
+#  email: progress-reports.py rendering every email and sending it over
+#    SMTP to a local server that throws the messages away
+# The script stages include starting Python and parsing the exports.
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+scriptDir = os.path.dirname(benchmarkDir)
+sys.path.insert(0, scriptDir)
+from masterycore import ScoreMatrix, parseOutcomeHeader, readMasteryRows
+
+allStages = ['header', 'rows', 'summary', 'stats', 'quizTeX', 'email']
+
+parser = argparse.ArgumentParser(description='Benchmark the mastery scripts on synthetic Canvas exports.')
+parser.add_argument('--students', default='100,1000,10000', help='text, comma separated class sizes to try (up to 50000 or more)')
+parser.add_argument('--stages', default=','.join(allStages), help='text, comma separated stages to time: ' + ', '.join(allStages))
+parser.add_argument('--groups', type=int, default=6, help='integer, number of outcome groups')
+parser.add_argument('--outcomesPerGroup', type=int, default=8, help='integer, number of outcomes in each group')
+parser.add_argument('--blank', type=float, default=0.3, help='number, fraction of blank mastery cells')
+parser.add_argument('--repeat', type=int, default=1, help='integer, run each stage this many times and keep the fastest')
+parser.add_argument('--realLatex', action='store_true', help='flag, run the real pdflatex in the quizTeX stage')
+parser.add_argument('--workDir', default='', help='folder path, where exports and outputs are generated (default: a temporary folder)')
+parser.add_argument('--output', default='benchmark.json', help='filepath, JSON file for the results')
+parser.add_argument('--baseline', default='', help='filepath, results of an earlier run to compare with')
+args = parser.parse_args()
+
+# An SMTP server that accepts everything and keeps nothing.
+class DiscardHandler(socketserver.StreamRequestHandler):
+    def reply(self, text):
+        self.wfile.write((text + '\r\n').encode())
+
+    def handle(self):
+        self.reply('220 benchmark')
+        inData = False
+        for line in self.rfile:
+            command = line.rstrip(b'\r\n')
+            if inData:
+                if command == b'.':
+                    inData = False
+                    self.reply('250 discarded')
+                continue
+            verb = command[:4].upper()
+            if verb in (b'EHLO', b'HELO'):
+                self.reply('250 benchmark')
+            elif verb == b'DATA':
+                inData = True
+                self.reply('354 go ahead')
+            elif verb == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+class DiscardServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def runScript(script, options, workDir, env=None):
+    command = [sys.executable, os.path.join(scriptDir, script)] + options
+    completed = subprocess.run(command, cwd=workDir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if completed.returncode != 0:
+        raise SystemExit('%s failed:\n%s' % (' '.join(command), completed.stderr.decode()))
+
+def timeHeader(dataDir):
+    with open(os.path.join(dataDir, 'Mastery.csv'), newline='') as masteryFile:
+        headers = next(csv.reader(masteryFile))
+    groups, outcomeArray, outcomeDict = parseOutcomeHeader(headers)
+    return len(outcomeArray)
+
+def timeRows(dataDir):
+    with open(os.path.join(dataDir, 'Mastery.csv'), newline='') as masteryFile:
+        dataStream = csv.reader(masteryFile)
+        headers = next(dataStream)
+        scoreMatrix = ScoreMatrix(range((len(headers)-2)//2))
+        for name, id, row in readMasteryRows(dataStream, scoreMatrix):
+            pass
+        scoreMatrix.masteryMask()
+    return scoreMatrix.numStudents
+
+def runStage(stage, dataDir, workDir, smtpPort, stubDir):
+    exportOptions = ['--studentData', os.path.join(dataDir, 'Grades.csv'),
+                     '--masteryData', os.path.join(dataDir, 'Mastery.csv'),
+                     '--outcomeFile', os.path.join(dataDir, 'OutcomeList.txt')]
+    if stage == 'header':
+        timeHeader(dataDir)
+    elif stage == 'rows':
+        timeRows(dataDir)
+    elif stage == 'summary':
+        runScript('progress-reports.py', exportOptions + ['--summary', os.path.join(workDir, 'Summary.txt')], workDir)
+    elif stage == 'stats':
+        runScript('progress-reports.py', exportOptions + ['--stats', os.path.join(workDir, 'Stats.csv')], workDir)
+    elif stage == 'email':
+        runScript('progress-reports.py', exportOptions + ['--mailer', 'smtp', '--smtpHost', 'localhost',
+                  '--smtpPort', str(smtpPort), '--connections', '4'], workDir)
+    elif stage == 'quizTeX':
+        quizDir = os.path.join(workDir, 'quizzes')
+        os.makedirs(quizDir, exist_ok=True)
+        env = dict(os.environ)
+        quizOptions = ['--csv', os.path.join(dataDir, 'Mastery.csv'),
+                       '--outcomes', os.path.join(dataDir, 'OutcomeList.txt'),
+                       '--quiz', os.path.join(dataDir, 'Quiz.tex'),
+                       '--quizDir', quizDir, '--force']
+        if not args.realLatex:
+            env['PATH'] = stubDir + os.pathsep + env.get('PATH', '')
+            # The failed combined compile keeps its scratch folder, so keep
+            # those in the work folder as well.
+            scratchDir = os.path.join(workDir, 'scratch')
+            shutil.rmtree(scratchDir, ignore_errors=True)
+            os.makedirs(scratchDir)
+            env['TMPDIR'] = scratchDir
+            quizOptions.append('--combined')
+        runScript('mastery-quizzes.py', quizOptions, workDir, env)
+
+stages = [ stage.strip() for stage in args.stages.split(',') if stage.strip() != '' ]
+for stage in stages:
+    if stage not in allStages:
+        raise SystemExit('Unknown stage %s, use some of: %s' % (stage, ', '.join(allStages)))
+classSizes = [ int(size) for size in args.students.split(',') if size.strip() != '' ]
+
+workRoot = args.workDir if args.workDir != '' else tempfile.mkdtemp(prefix='mastery-benchmark-')
+os.makedirs(workRoot, exist_ok=True)
+
+# pdflatex stand-in for the quizTeX stage.
+stubDir = os.path.join(workRoot, 'stub')
+os.makedirs(stubDir, exist_ok=True)
+with open(os.path.join(stubDir, 'pdflatex'), 'w') as stubFile:
+    stubFile.write('#!/bin/sh\nexit 0\n')
+os.chmod(os.path.join(stubDir, 'pdflatex'), 0o755)
+
+smtpServer = DiscardServer(('localhost', 0), DiscardHandler)
+threading.Thread(target=smtpServer.serve_forever, daemon=True).start()
+smtpPort = smtpServer.server_address[1]
+
+try:
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=scriptDir,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+except OSError:
+    commit = ''
+
+results = []
+for numStudents in classSizes:
+    dataDir = os.path.join(workRoot, 'data-%d' % numStudents)
+    runScript(os.path.join('benchmarks', 'make-exports.py'), ['--outDir', dataDir,
+              '--students', str(numStudents), '--groups', str(args.groups),
+              '--outcomesPerGroup', str(args.outcomesPerGroup), '--blank', str(args.blank)], workRoot)
+    workDir = os.path.join(workRoot, 'work-%d' % numStudents)
+    os.makedirs(workDir, exist_ok=True)
+    for stage in stages:
+        best = None
+        for attempt in range(max(1, args.repeat)):
+            startTime = time.perf_counter()
+            runStage(stage, dataDir, workDir, smtpPort, stubDir)
+            elapsed = time.perf_counter() - startTime
+            best = elapsed if best is None else min(best, elapsed)
+        results.append({ 'students': numStudents, 'stage': stage, 'seconds': round(best, 4),
+                         'perStudentMs': round(1000.0 * best / max(1, numStudents), 4) })
+        print('%7d students  %-8s %9.3f s' % (numStudents, stage, best))
+
+smtpServer.shutdown()
+if args.workDir == '':
+    shutil.rmtree(workRoot, ignore_errors=True)
+
+report = { 'commit': commit, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+           'python': platform.python_version(), 'platform': platform.platform(),
+           'groups': args.groups, 'outcomesPerGroup': args.outcomesPerGroup,
+           'blank': args.blank, 'results': results }
+with open(args.output, 'w') as outputFile:
+    json.dump(report, outputFile, indent=1)
+print('Results written to', args.output)
+
+# Compare with an earlier run: a ratio above 1 means slower than before.
+if args.baseline != '':
+    with open(args.baseline, 'r') as baselineFile:
+        baseline = json.load(baselineFile)
+    before = dict([ ((entry['students'], entry['stage']), entry['seconds']) for entry in baseline['results'] ])
+    print('Compared with %s (commit %s):' % (args.baseline, baseline.get('commit', '')))
+    for entry in results:
+        previous = before.get((entry['students'], entry['stage']))
+        if previous is None or previous == 0:
+            continue
+        print('%7d students  %-8s %9.3f s -> %9.3f s  (x%.2f)' % (entry['students'], entry['stage'],
+              previous, entry['seconds'], entry['seconds'] / previous))
@@ -0,0 +1,295 @@
+# Delivery of the emails prepared by the mastery scripts.
+# A backend takes messages with submit(address, subject, body, attachments,
+# onSent) and close() waits until everything is delivered, returning a list
+# of failures as (address, reason). onSent, if given, is called once the
+# message has been handed over (possibly from another thread).
+#
+# applemail: the original Mac-specific path. AppleScript pushes each message
+#   into Apple Mail as a draft, which can then be checked and sent by hand.
+# smtp: messages are built in memory and sent over a few persistent SMTP
+#   connections at the same time, optionally limited to a number of
+#   messages per second. For a trial run, point it at a local stand-in
+#   server, e.g. (Python 3.11 or earlier)
+#     python3 -m smtpd -n -c DebuggingServer localhost:1025
+#   and use --mailer smtp --smtpHost localhost --smtpPort 1025
+
+import os
+import mimetypes
+import smtplib
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+defaultSender = 'D. Brian Walton <waltondb@jmu.edu>'
+
+def asrun(ascript):
+    "Run the given AppleScript and return the standard output, raising CalledProcessError if it fails."
+
+    osa = subprocess.Popen(['osascript', '-'],
+                           stdin=subprocess.PIPE,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE)
+    output, error = osa.communicate(ascript)
+    if osa.returncode != 0:
+        raise subprocess.CalledProcessError(osa.returncode, 'osascript', output, error)
+    return output
+
+def asquote(astr):
+    "Return the AppleScript equivalent of the given string."
+
+    astr = astr.replace('"', '" & quote & "')
+    return '"{}"'.format(astr)
+
+# Command line options shared by the scripts that send email.
+def addMailOptions(parser):
+    parser.add_argument('--mailer', default='applemail', choices=['applemail', 'smtp'], help='text, applemail to create drafts in Mail, smtp to send directly')
+    parser.add_argument('--sender', default=defaultSender, help='text, From address of the messages')
+    parser.add_argument('--smtpHost', default='localhost', help='text, SMTP server for --mailer smtp')
+    parser.add_argument('--smtpPort', type=int, default=587, help='integer, SMTP server port')
+    parser.add_argument('--smtpUser', default='', help='text, SMTP login name (the password is read from the SMTP_PASSWORD environment variable)')
+    parser.add_argument('--smtpTLS', action='store_true', help='flag, use STARTTLS on the SMTP connections')
+    parser.add_argument('--connections', type=int, default=2, help='integer, number of SMTP connections sending at the same time')
+    parser.add_argument('--rate', type=float, default=0, help='number, most messages per second over all connections (0 for no limit)')
+    parser.add_argument('--retries', type=int, default=3, help='integer, number of times to retry a message after a temporary SMTP failure')
+
+# Create the backend chosen on the command line.
+# tempFile is where Apple Mail drafts are staged (a private file if empty).
+# With a profiler (see masteryprofile.py), every message is timed.
+def createBackend(args, tempFile='', profiler=None):
+    if args.mailer == 'smtp':
+        return SMTPBackend(args.smtpHost, args.smtpPort, args.sender,
+                           args.smtpUser, os.environ.get('SMTP_PASSWORD', ''),
+                           args.smtpTLS, args.connections, args.rate, args.retries, profiler)
+    return AppleMailBackend(args.sender, tempFile, profiler)
+
+# Build a complete message in memory, with any files attached.
+def buildMessage(sender, address, subject, body, attachments=[]):
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = address
+    message['Subject'] = subject
+    message.set_content(body)
+    for filePath in attachments:
+        fileType, encoding = mimetypes.guess_type(filePath)
+        if fileType is None or encoding is not None:
+            fileType = 'application/octet-stream'
+        mainType, subType = fileType.split('/', 1)
+        with open(filePath, 'rb') as attachmentFile:
+            message.add_attachment(attachmentFile.read(), maintype=mainType,
+                                   subtype=subType, filename=os.path.basename(filePath))
+    return message
+
+# I couldn't get direct Python email to work on my Mac, so this uses
+# AppleScript to send each message to Mail as a draft, which I could then
+# send. (It is possible to send directly from AppleScript, but that made me
+# nervous. To send directly, add a line
+# send
+# immediately after "set content to msg")
+# The body goes through tempFile, so messages are handled one at a time.
+# Without a tempFile, each run stages its drafts in its own temporary file
+# (removed by close), so that several runs do not overwrite each other.
+# A draft that osascript could not create is not counted as sent: it is
+# returned by close with the other failures.
+class AppleMailBackend:
+    def __init__(self, sender, tempFile='', profiler=None):
+        self.sender = sender
+        self.profiler = profiler
+        self.failures = []
+        self.ownsTempFile = (tempFile == '')
+        if self.ownsTempFile:
+            handle, tempFile = tempfile.mkstemp(prefix='tmpmsg-', suffix='.txt')
+            os.close(handle)
+        self.tempFile = tempFile
+
+    def submit(self, address, subject, body, attachments=[], onSent=None):
+        startTime = time.perf_counter()
+        with open(self.tempFile, 'w') as messageStream:
+            messageStream.write(body)
+        attachScript = ''
+        for filePath in attachments:
+            attachScript = attachScript + """
+          tell content of theOutMessage
+            make new attachment with properties {file name:%s} at after last paragraph
+          end tell""" % asquote(os.path.abspath(filePath))
+        mailScript = """
+    set m to POSIX file %s
+    set msg to read m
+    tell application "Mail"
+      activate
+      set theOutMessage to make new outgoing message with properties {visible:true}
+      tell theOutMessage
+          make new to recipient at end of to recipients with properties {address:%s}
+          set sender to %s
+          set subject to %s
+          set content to msg
+      end tell%s
+    end tell
+    """ % ( asquote(os.path.abspath(self.tempFile)), asquote(address),
+            asquote(self.sender), asquote(subject), attachScript )
+        status = 'ok'
+        try:
+            asrun(mailScript.encode())
+        except (subprocess.CalledProcessError, OSError) as err:
+            status = 'failed'
+            if isinstance(err, subprocess.CalledProcessError):
+                reason = 'osascript exit status %d: %s' % (err.returncode, err.stderr.decode(errors='replace').strip())
+            else:
+                reason = str(err)
+            self.failures.append((address, reason))
+        if self.profiler is not None:
+            self.profiler.record('mail', time.perf_counter() - startTime, address=address, status=status)
+        if onSent is not None and status == 'ok':
+            onSent()
+
+    def close(self):
+        if self.ownsTempFile and os.path.exists(self.tempFile):
+            os.remove(self.tempFile)
+        failures = self.failures
+        self.failures = []
+        return failures
+
+# Temporary failures are worth another try: lost connections and 4xx replies,
+# also when every recipient was refused with one (greylisting, a busy
+# mailbox). A 5xx reply will not get better by waiting.
+def isTemporaryFailure(err):
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return len(err.recipients) > 0 and all([ code < 500 for code, message in err.recipients.values() ])
+    if isinstance(err, smtplib.SMTPResponseException):
+        return err.smtp_code < 500
+    return True
+
+# Sends messages over SMTP from a small pool of worker threads. Each worker
+# builds its messages (reading and encoding the attachments) and keeps its
+# own connection open for all of them, so encoding one message overlaps with
+# sending the others. A shared clock spaces the sends so that no more than
+# `rate` messages per second go out in total. After a temporary failure the
+# connection is dropped and the message is tried again, waiting 1, 2, 4, ...
+# seconds, up to `retries` times.
+# With a profiler, each message records how long it waited in the queue and
+# how long it took from then on to be delivered (or to fail).
+class SMTPBackend:
+    def __init__(self, host, port, sender, user='', password='', useTLS=False, connections=2, rate=0, retries=3, profiler=None):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.user = user
+        self.password = password
+        self.useTLS = useTLS
+        self.interval = 1.0/rate if rate > 0 else 0.0
+        self.retries = max(0, retries)
+        self.profiler = profiler
+        self.nextSend = time.monotonic()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.servers = []
+        self.pending = []
+        self.pool = ThreadPoolExecutor(max_workers=max(1, connections))
+
+    def connect(self):
+        server = smtplib.SMTP(self.host, self.port)
+        if self.useTLS:
+            server.starttls()
+        if self.user != '':
+            server.login(self.user, self.password)
+        with self.lock:
+            self.servers.append(server)
+        self.local.server = server
+        return server
+
+    def waitForTurn(self):
+        if self.interval == 0:
+            return
+        with self.lock:
+            sendAt = max(self.nextSend, time.monotonic())
+            self.nextSend = sendAt + self.interval
+        time.sleep(max(0.0, sendAt - time.monotonic()))
+
+    def disconnect(self):
+        server = getattr(self.local, 'server', None)
+        if server is None:
+            return
+        self.local.server = None
+        with self.lock:
+            self.servers.remove(server)
+        try:
+            server.close()
+        except OSError:
+            pass
+
+    def deliver(self, address, subject, body, attachments, onSent, submitTime):
+        startTime = time.perf_counter()
+        status = 'failed'
+        try:
+            message = buildMessage(self.sender, address, subject, body, attachments)
+            for attempt in range(self.retries + 1):
+                self.waitForTurn()
+                try:
+                    server = getattr(self.local, 'server', None) or self.connect()
+                    server.send_message(message)
+                    break
+                except (smtplib.SMTPException, OSError) as err:
+                    if attempt == self.retries or not isTemporaryFailure(err):
+                        raise
+                    self.disconnect()
+                    time.sleep(2 ** attempt)
+            status = 'ok'
+        finally:
+            if self.profiler is not None:
+                self.profiler.record('mail', time.perf_counter() - startTime, address=address,
+                                     status=status, queued=round(startTime - submitTime, 6))
+        if onSent is not None:
+            onSent()
+
+    def submit(self, address, subject, body, attachments=[], onSent=None):
+        self.pending.append((address, self.pool.submit(self.deliver, address, subject, body,
+                                                       list(attachments), onSent, time.perf_counter())))
+
+    def close(self):
+        failures = []
+        for address, future in self.pending:
+            try:
+                future.result()
+            except Exception as err:
+                failures.append((address, str(err)))
+        self.pending = []
+        self.pool.shutdown()
+        for server in self.servers:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+        return failures
+
+# An append-only record of what has already been delivered, one line per
+# message: key, content hash and time, separated by tabs. Every line is
+# flushed to disk as soon as the message is delivered, so after a crash a
+# rerun can skip everything that went out before it. A partial last line
+# simply does not match anything.
+class DeliveryJournal:
+    def __init__(self, journalPath):
+        self.path = journalPath
+        self.delivered = set()
+        self.lock = threading.Lock()
+        if os.path.exists(journalPath):
+            with open(journalPath, 'r') as journalFile:
+                for line in journalFile:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) >= 3:
+                        self.delivered.add((fields[0], fields[1]))
+        self.journalFile = open(journalPath, 'a')
+
+    def isDelivered(self, key, contentHash):
+        return (key, contentHash) in self.delivered
+
+    def record(self, key, contentHash):
+        with self.lock:
+            self.journalFile.write('%s\t%s\t%s\n' % (key, contentHash, time.strftime('%Y-%m-%d %H:%M:%S')))
+            self.journalFile.flush()
+            os.fsync(self.journalFile.fileno())
+            self.delivered.add((key, contentHash))
+
+    def close(self):
+        self.journalFile.close()
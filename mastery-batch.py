@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from masteryprofile import percentile
+
+# Run the mastery scripts for several courses (or sections) in one go, from
+# a JSON file listing each course with the options it would be given on the
+# command line, either as one string or as a list:
+#  {
+#   "quizzes": "--formatCache fmtCache/ --prunePreamble",
+#   "reports": "--mailer smtp --smtpHost localhost --smtpPort 1025",
+#   "courses": [
+#    { "name": "math231-1",
+#      "quizzes": "--csv M231/Mastery.csv --outcomes M231/OutcomeList.txt --quiz M231/Quiz.tex --quizDir M231/quizzes/",
+#      "reports": "--studentData M231/Grades.csv --masteryData M231/Mastery.csv --outcomeFile M231/OutcomeList.txt" },
+#    ...
+#   ]
+#  }
+# The options at the top level come before those of every course, so the
+# courses can share a --formatCache or --fragments folder (their files are
+# named by a hash of what went into them, so templates never mix) and the
+# mail settings. Relative paths are taken from the folder of the JSON file.
+#
+# Steps: "quizzes" runs mastery-quizzes.py, "reports" progress-reports.py
+# and "emails" email-quizzes.py. The quiz compiles of several courses run
+# at the same time, with --jobs pdflatex runs shared out between them: each
+# course gets an equal share of at least 2, and when there are more courses
+# than shares, the others wait and each starts as soon as a course is done.
+# (The share of a course is fixed while it runs, so the quiz options cannot
+# set --jobs themselves.) With --jobs 1, the courses compile one at a time.
+# Then the reports and emails go out one course at a time, so the mail
+# server sees a single sender at the rate set in the options.
+# Every step is profiled (see masteryprofile.py), and the run ends with the
+# time of each step and the pdflatex, quiz and mail timings of all courses.
+
+steps = [ ('quizzes', 'mastery-quizzes.py'), ('reports', 'progress-reports.py'), ('emails', 'email-quizzes.py') ]
+
+parser = argparse.ArgumentParser(description='Run the mastery scripts for every course listed in a JSON file.')
+parser.add_argument('config', help='file path, JSON list of courses and the options of their scripts')
+parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='integer, pdflatex runs at the same time over all courses')
+parser.add_argument('--courses', default='', help='text, comma separated names of the courses to run (default: all)')
+parser.add_argument('--steps', default=','.join([ step for step, script in steps ]), help='text, comma separated steps to run: quizzes, reports, emails')
+parser.add_argument('--profileDir', default='', help='folder path, where the profile of every step is kept (default: a temporary folder)')
+args = parser.parse_args()
+
+with open(args.config, 'r') as configFile:
+    config = json.load(configFile)
+configDir = os.path.dirname(os.path.abspath(args.config))
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+courses = config['courses']
+if args.courses != '':
+    chosen = [ name.strip() for name in args.courses.split(',') ]
+    courses = [ course for course in courses if course['name'] in chosen ]
+chosenSteps = [ step.strip() for step in args.steps.split(',') if step.strip() != '' ]
+for step in chosenSteps:
+    if step not in dict(steps):
+        raise SystemExit('Unknown step %s, use some of: %s' % (step, ', '.join(dict(steps))))
+
+profileDir = args.profileDir if args.profileDir != '' else tempfile.mkdtemp(prefix='mastery-batch-')
+os.makedirs(profileDir, exist_ok=True)
+
+def optionList(options):
+    return shlex.split(options) if isinstance(options, str) else list(options)
+
+# The quiz compiles are shared out here, so --jobs is not allowed in the
+# quiz options.
+for name, options in [ ('the top level', config.get('quizzes', [])) ] + [ (course['name'], course.get('quizzes', [])) for course in courses ]:
+    if any([ option == '--jobs' or option.startswith('--jobs=') for option in optionList(options) ]):
+        raise SystemExit('Remove --jobs from the quiz options of %s, mastery-batch.py --jobs sets it for all courses' % name)
+
+def profilePath(course, step):
+    return os.path.join(os.path.abspath(profileDir), '%s-%s.jsonl' % (course['name'], step))
+
+# Run one step of a course, with its output gathered so that courses
+# running at the same time do not interleave their lines.
+# Returns (course name, step, exit status, output).
+def runStep(course, step, extraOptions=[]):
+    command = ([sys.executable, os.path.join(scriptDir, dict(steps)[step])] + extraOptions
+               + optionList(config.get(step, [])) + optionList(course[step])
+               + ['--profile', profilePath(course, step)])
+    process = subprocess.run(command, cwd=configDir, stdin=subprocess.DEVNULL,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return course['name'], step, process.returncode, process.stdout.decode(errors='replace')
+
+def report(result):
+    name, step, returncode, output = result
+    print('== %s %s (exit status %d)' % (name, step, returncode))
+    print(output.rstrip('\n'))
+    return returncode
+
+startTime = time.perf_counter()
+statuses = []
+
+# The quiz compiles, several courses at once. Each course gets its share of
+# --jobs, but at least 2, so that every quiz compiles in its own scratch
+# folder and courses sharing a folder never overwrite each other's
+# Questions.tex. Only as many courses run as there are shares, so no more
+# than --jobs pdflatex runs happen at the same time.
+quizCourses = [ course for course in courses if 'quizzes' in chosenSteps and 'quizzes' in course ]
+if len(quizCourses) > 0:
+    if args.jobs < 2:
+        courseJobs, numRunning = 1, 1
+    else:
+        courseJobs = max(2, args.jobs // len(quizCourses))
+        numRunning = args.jobs // courseJobs
+    with ThreadPoolExecutor(max_workers=numRunning) as pool:
+        futures = [ pool.submit(runStep, course, 'quizzes', ['--jobs', str(courseJobs)]) for course in quizCourses ]
+        for future in futures:
+            statuses.append(report(future.result()))
+
+# Then whatever sends mail, one course at a time.
+for course in courses:
+    for step in ['reports', 'emails']:
+        if step in chosenSteps and step in course:
+            statuses.append(report(runStep(course, step)))
+
+# Combined timing summary.
+elapsed = time.perf_counter() - startTime
+print('Batch of %d courses: %.3f s in total' % (len(courses), elapsed))
+timings = dict()
+for course in courses:
+    for step, script in steps:
+        if not os.path.exists(profilePath(course, step)):
+            continue
+        with open(profilePath(course, step), 'r') as profileFile:
+            for line in profileFile:
+                entry = json.loads(line)
+                if entry['event'] == 'total':
+                    print('  %-20s %-8s %9.3f s' % (course['name'], step, entry['seconds']))
+                elif entry['event'] != 'stage':
+                    timings.setdefault(entry['event'], []).append(entry['seconds'])
+for event, times in timings.items():
+    times = sorted(times)
+    print('  %-12s %6d x  p50 %.3f s  p95 %.3f s  max %.3f s  total %.3f s'
+          % (event, len(times), percentile(times, 0.5), percentile(times, 0.95), times[-1], sum(times)))
+if 'pdflatex' in timings:
+    print('  pdflatex kept %.1f of %d job slots busy on average' % (sum(timings['pdflatex']) / elapsed, args.jobs))
+if args.profileDir == '':
+    for fileName in os.listdir(profileDir):
+        os.remove(os.path.join(profileDir, fileName))
+    os.rmdir(profileDir)
+
+failed = len([ status for status in statuses if status != 0 ])
+if failed > 0:
+    raise SystemExit('%d of %d steps failed' % (failed, len(statuses)))
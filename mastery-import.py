@@ -0,0 +1,45 @@
+import argparse
+import json
+from masterystore import MasteryStore
+
+# Load this week's Canvas exports into the SQLite store (see masterystore.py),
+# so that mastery-quizzes.py, progress-reports.py and email-quizzes.py can
+# read them with --store instead of parsing the CSV files on every run.
+# The new snapshot is compared with the previous one, and the students whose
+# mastery changed can be written out with --changes.
+
+parser = argparse.ArgumentParser(description='Import a Canvas gradebook and mastery export file into a local store shared by the mastery scripts.')
+parser.add_argument('--store', help='file path, SQLite store (created if needed)')
+parser.add_argument('--studentData', default='', help='file path, CSV of Canvas grade export to get names, logins and sections')
+parser.add_argument('--masteryData', default='', help='file path, CSV of Canvas learning mastery report')
+parser.add_argument('--date', default='', help='date (YYYY-MM-DD), snapshot date of the exports (default: today, replacing an earlier import of the same day); without exports, the snapshot to compare')
+parser.add_argument('--changes', default='', help='filepath, JSON file listing the students and outcomes that changed since the previous snapshot')
+args = parser.parse_args()
+
+if len(args.studentData) > 0 and len(args.masteryData) > 0:
+    store = MasteryStore(args.store)
+    importDate, numRoster, numMastery = store.importExports(args.studentData, args.masteryData, args.date)
+    print('Snapshot %s: %d students in the gradebook, %d in the mastery export.' % (importDate, numRoster, numMastery))
+else:
+    store = MasteryStore(args.store, args.date)
+print('Snapshots in the store:', ', '.join(store.importDates()))
+
+# Compare with the previous snapshot, naming outcomes by their export title.
+changes = store.changedOutcomes()
+if changes is None:
+    print('No previous snapshot to compare with.')
+else:
+    headers = store.readMasteryHeader()
+    names = dict([ (id, name) for name, id, login, section in store.readRoster() ])
+    print('%d students changed since the previous snapshot.' % len(changes))
+    if len(args.changes) > 0:
+        students = dict()
+        for id, outcomes in changes.items():
+            if outcomes is None:
+                titles = None
+            else:
+                titles = sorted([ headers[2+2*i][:-7] for i in outcomes ])
+            students[id] = { 'name': names.get(id, ''), 'outcomes': titles }
+        with open(args.changes, 'w') as changesFile:
+            json.dump({ 'snapshot': store.importDate(), 'students': students }, changesFile, indent=1)
+store.close()
@@ -1,6 +1,19 @@
 import csv
 import argparse
 import subprocess
+import os
+import re
+import hashlib
+import io
+import json
+import operator
+import time
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from masterycore import ScoreMatrix, StudentRecord, getOutcomeCode, parseOutcomeHeader, readMasteryRows
+from masterystore import addStoreOptions, MasteryStore
+from masteryprofile import addProfileOptions, Profiler
 
 parser = argparse.ArgumentParser(description='Import a Canvas mastery export file and produce a summary.')
 parser.add_argument('--csv', dest='csvFile', help='file path, CSV of Canvas learning mastery report')
@@ -11,124 +24,35 @@ parser.add_argument('--week', dest='week', type=int, default=0, help='integer, i
 parser.add_argument('--students', dest='studentData', default='', help='file path, CSV of Canvas grade export to get section information')
 parser.add_argument('--doneScore', type=int, default=3, help='integer, skip problems of outcomes if already achieve this')
 parser.add_argument('--apprenticeScore', type=int, default=2, help='integer, mark problems of outcomes if at this level')
+parser.add_argument('--jobs', type=int, default=1, help='integer, number of quizzes to compile at the same time, each in its own scratch folder')
+parser.add_argument('--formatCache', default='', help='folder path, where a precompiled format of the quiz preamble is cached (needs mylatexformat)')
+parser.add_argument('--force', action='store_true', help='flag, compile every quiz even if the manifest shows it is unchanged')
+parser.add_argument('--dedupe', action='store_true', help='flag, compile each distinct set of problems once and stamp student names onto copies (needs qpdf)')
+parser.add_argument('--fragments', default='', help='folder path, where each problem is cached as a compiled PDF fragment so quizzes only place images (needs qpdf and the preview package)')
+parser.add_argument('--combined', action='store_true', help='flag, compile every quiz in one pdflatex run and split the result into one PDF per student (needs qpdf)')
+parser.add_argument('--timeout', type=int, default=300, help='integer, seconds before a pdflatex run is stopped (0 for no limit)')
+parser.add_argument('--prunePreamble', action='store_true', help='flag, give each quiz a copy of the template holding only the problems it uses')
+parser.add_argument('--retryFailed', '--retry-failed', dest='retryFailed', action='store_true', help='flag, only compile the quizzes that failed in the previous run (listed in failed.json in quizDir)')
+addStoreOptions(parser)
+addProfileOptions(parser)
 args = parser.parse_args()
+profiler = Profiler('mastery-quizzes', args.profile, args.cprofile)
+# The quizzes, manifest and logs all go into args.quizDir.
+os.makedirs(args.quizDir, exist_ok=True)
 
-# Some structure to keep track of outcomes, organized by groups.
-class Outcome:
-    def __init__(self, groupCode, groupTitle, outcomeCode, outcomeTitle, index):
-        self.groupCode = groupCode
-        self.groupTitle = groupTitle
-        self.outcomeCode = outcomeCode
-        self.outcomeTitle = outcomeTitle
-        self.index = index
-    def codeStr(self):
-        return (getOutcomeCode(self.groupCode, self.outcomeCode))
-
-# Some structure to keep track of who a student is and what they have done.
-class StudentRecord:
-    def __init__(self, student_name, student_id, student_results):
-        self.name = student_name
-        self.id = student_id
-        self.results = student_results
-    def getLastFirst(self):
-        names = self.name.split(' ')
-        return ','.join([names[-1], ' '.join(names[:-1])])
-    def getLastFirstTight(self):
-        names = self.name.split(' ')
-        return ''.join([names[-1], ''.join(names[:-1])])
-
-# Groups are where learning outcomes are organized
-# On Canvas, I have learning outcomes grouped into a hierarchy
-# Each group has a simple code and a descriptor
-# For example "G1: Functions"
-# The script uses the G1 as the group code and Functions as the title.
-# Similarly, an outcome has a code and a title in a similar vein.
-# For example "F1: Defining Functions"
-# The outcome code would be F1 and the title would be Defining Functions
-groups = dict()
-outcomeArray = []
-outcomeDict = dict()
-def addOutcome(outcome):
-    code = outcome.codeStr()
-    outcomeDict[code] = outcome
-    outcomeArray.append(outcome)
-    group = groups.get(outcome.groupCode, { 'title':outcome.groupTitle, 'outcomes': [] })
-    group['outcomes'].append(outcome.outcomeCode)
-    groups[outcome.groupCode] = group
-
-# In the script, outcomes have both a group and outcomes
-# This allows us to sort by groups if desired.
-# Using the example above, this function would return "G1.F1" as the outcome code.
-def getOutcomeCode(group, outcome):
-    return '.'.join([group, outcome])
-
-# Parse the first row of the data table
-# Extracts the information for outcome descriptions
-# My Outcome Titles include the Outcome and Title, so we pull this off for tracking.
-def parseHeader(headers, numberOutcomes):
-    # Canvas exports outcome information in the headers.
-    # Column 1: Student Name
-    # Column 2: Student # ID
-    # Pairs of columns:
-    #  "Outcome_Title result"
-    #  "Outcome_Title mastery points"
-    for i in range(numberOutcomes):
-        col = 2+2*i
-        outcome = headers[col]
-        # Group title separated from Outcome title by '>'
-        parts = outcome.split('>')
-
-        # Group and outcome titles use ShortCode: Title
-        groupInfo = [ text.strip() for text in parts[0].split(':') ]
-        groupCode = groupInfo[0]
-        groupTitle = ': '.join(groupInfo[1:])
-
-        outcomeInfo = [ text.strip() for text in parts[1].split(':') ]
-        outcomeCode = outcomeInfo[0]
-        outcomeTitle = ': '.join(outcomeInfo[1:])
-        # Remove the ' result' from end of title
-        outcomeTitle = outcomeTitle[:-7]
-
-        # Generate the outcome record
-        outcome = Outcome(groupCode, groupTitle, outcomeCode, outcomeTitle, i)
-        addOutcome(outcome)
-
-# Parse one row of the table corresponding to a student's mastery record
-# The ordering of columns is described above in parseHeader
-def parseRow(studentRecord, numOutcomes):
-    # Column 1: name
-    name = studentRecord[0]
-    # Column 2: student_id
-    id = studentRecord[1]
-
-    # Remaining columns in pairs corresponding to mastery data
-    # - points earned
-    # - required for mastery
-    results = []
-    for i in range(numOutcomes):
-        k = 2+2*i
-        mastered = False
-        if len(studentRecord[k])==0:
-            score = 0.0
-        else:
-            score = float(studentRecord[k])
-        if len(studentRecord[k+1])==0:
-            required = 0.0
-        else:
-            required = float(studentRecord[k+1])
-        results.append({ 'score': score, 'mastery': (score >= args.doneScore) })
-
-    record = StudentRecord(name, id, results)
+# Create the record for one row of the table corresponding to a student's
+# mastery record. The ordering of columns is described in parseOutcomeHeader
+# Column 1 is the name and column 2 the student_id, while the remaining
+# columns in pairs (points earned, required for mastery) were already read
+# into the given row of the score matrix by readMasteryRows.
+def parseRow(name, id, row):
+    record = StudentRecord(name, id, row)
     return record
 
 # I like to have a template quiz generated.
 # So this creates the fake student where that will be used.
 def BlankStudent(numOutcomes):
-    results = []
-    for i in range(numOutcomes):
-        results.append({ 'score': 0.0, 'mastery': False })
-
-    record = StudentRecord('Problem Template', '', results)
+    record = StudentRecord('Problem Template', '', scoreMatrix.addBlankRow())
     return record
 
 # Use the records for the student and the outcomes to generate a new quiz
@@ -147,88 +71,753 @@ def BlankStudent(numOutcomes):
 #\include{Questions}
 #\end{document}
 #
-def generateQuiz(studentRecord):
-    # Create a personalized quiz for each student.
-    with open('Questions.tex', 'w') as quizFile:
-        # Display student header information
-        quizFile.write('\\setcounter{page}{1}\n\\markright{')
-        #quizFile.write('{\\flushright \\textbf{')
-        quizFile.write(studentRecord.name)
-        if args.studentData != '':
+# Names and sections come from the exports, so characters with a special
+# meaning in TeX (such as & or _) are escaped before they are typeset.
+texSpecials = { '\\': '\\textbackslash{}', '&': '\\&', '%': '\\%', '$': '\\$', '#': '\\#',
+                '_': '\\_', '{': '\\{', '}': '\\}', '~': '\\textasciitilde{}', '^': '\\textasciicircum{}' }
+texSpecialPattern = re.compile(r'[\\&%$#_{}~^]')
+def texEscape(text):
+    return texSpecialPattern.sub(lambda match: texSpecials[match.group(0)], text)
+
+def writeHeader(quizFile, studentRecord, blankHeader=False):
+    # Display student header information
+    quizFile.write('\\setcounter{page}{1}\n\\markright{')
+    #quizFile.write('{\\flushright \\textbf{')
+    if not blankHeader:
+        quizFile.write(texEscape(studentRecord.name))
+        if useSections:
             section = studentSections.get(studentRecord.name, "Both")
-            quizFile.write(' (' + section + ')')
-        quizFile.write('}\n\n')
-
-        quizFile.write('\\header\n\n')
-        quizFile.write('\\begin{enumerate}\n')
-
-        # Identify which outcomes already are passed.
-        masteredList = []
-        for outcomeRow in useOutcomes:
-            code = getOutcomeCode(outcomeRow[0], outcomeRow[1])
-            outcome = outcomeDict[code]
-            if studentRecord.results[outcome.index]['mastery']:
-                masteredList.append(outcome.outcomeCode)
-
-        if len(masteredList) > 0:
-            quizFile.write('\\objMastery{')
-            quizFile.write(', '.join(masteredList))
-            quizFile.write('}\n\n')
-
-        # Then add all of the problems not mastered.
-        for outcomeRow in useOutcomes:
-            code = getOutcomeCode(outcomeRow[0], outcomeRow[1])
-            outcome = outcomeDict[code]
-            if not studentRecord.results[outcome.index]['mastery']:
-                quizFile.write('\\obj')
-                quizFile.write(outcomeRow[2])
-                if studentRecord.results[outcome.index]['score'] == args.apprenticeScore:
-                    quizFile.write('{ (A)}\n')
-                else:
-                    quizFile.write('{}\n')
-                masteredList.append(outcome.outcomeCode)
-        quizFile.write('\\end{enumerate}\n\n\\cleardoublepage \n\n')
-    # Now that the problems were generated, run pdflatex to create the quiz.
-    print(args.quizDir, args.quizInclude)
-    process = subprocess.run(['pdflatex',
-        '-jobname',studentRecord.getLastFirstTight().lower(),
-        '-output-directory', args.quizDir,
-        args.quizInclude])
+            quizFile.write(' (' + texEscape(section) + ')')
+    quizFile.write('}\n\n')
 
-# Here is where the real work takes place.
-# First load the file containing mastery data from Canvas report export.
-# Parse the data file to create our desired information
-with open(args.csvFile, newline='') as masteryFile:
-    # Create an iterator to go through the rows on the file.
-    dataStream = csv.reader(masteryFile)
+# The part of a quiz after the header only depends on what the student has
+# to do for each outcome in use (see ScoreMatrix.quizCodes), so it is
+# written once for each pattern of codes and then reused.
+quizBodies = dict()
+def quizCodesOf(studentRecord):
+    base = scoreMatrix.offset(studentRecord.row)
+    return pickActive(studentQuizCodes[base:base + scoreMatrix.numOutcomes])
 
-    # The first row has header information
-    # Read and then parse this information into something useful for us.
-    headers = next(dataStream)
-    numberOutcomes = (len(headers)-2)//2
-    parseHeader(headers, numberOutcomes)
+def quizBody(codes):
+    body = quizBodies.get(codes)
+    if body is not None:
+        return body
+    parts = ['\\header\n\n', '\\begin{enumerate}\n']
 
-    # All other rows are individual student records
-    studentData = [ parseRow(row, numberOutcomes) for row in dataStream ]
+    # Identify which outcomes already are passed.
+    masteredList = [ activeCodes[k] for k, code in enumerate(codes) if code == 0 ]
+    if len(masteredList) > 0:
+        parts.append('\\objMastery{' + ', '.join(masteredList) + '}\n\n')
 
-# Second, read information about students and which sections they are in.
-# It gets printed in the header for convenience on paper copies
-# Parse the student data file to organize the printing
-if (args.studentData != ''):
-    studentSections = dict()
-    with open(args.studentData, newline='') as studentInfoFile:
-        # Create an iterator to go through the rows on the file.
-        dataStream = csv.reader(studentInfoFile)
+    # Then add all of the problems not mastered.
+    for k, code in enumerate(codes):
+        if code != 0:
+            parts.append('\\obj' + activeStems[k] + ('{ (A)}\n' if code == 2 else '{}\n'))
+    parts.append('\\end{enumerate}\n\n')
+    body = ''.join(parts)
+    quizBodies[codes] = body
+    return body
 
-        # The first row has header information
-        # Read and then parse this information into something useful for us.
-        headers = next(dataStream)
-        for student in dataStream:
-            name = student[0]
-            section = student[4]
-            studentSections[name] = section
+def writeQuestions(quizFile, studentRecord, startLabel='', blankHeader=False):
+    # In a combined document, the label records the absolute page number
+    # (counting every page shipped out) where this quiz starts.
+    if startLabel != '':
+        quizFile.write('\\makeatletter\\write\\@auxout{\\string\\newlabel{' + startLabel
+                       + '}{{}{\\the\\c@abspage}}}\\makeatother\n')
+    writeHeader(quizFile, studentRecord, blankHeader)
+    quizFile.write(quizBody(quizCodesOf(studentRecord)))
+    quizFile.write('\\cleardoublepage \n\n')
+
+def generateQuiz(studentRecord):
+    jobName = studentRecord.getLastFirstTight().lower()
+    with profiler.timed('quiz', job=jobName):
+        # Create a personalized quiz for each student.
+        with open('Questions.tex', 'w') as quizFile:
+            writeQuestions(quizFile, studentRecord)
+        # Now that the problems were generated, run pdflatex to create the quiz.
+        print(args.quizDir, args.quizInclude)
+        pdfFile = os.path.join(args.quizDir, jobName + '.pdf')
+        with profiler.timed('pdflatex', job=jobName) as timing:
+            compileStart = time.time()
+            startTime = time.perf_counter()
+            returncode = runTeX(['pdflatex'] + texOptions + formatOptions() + [
+                '-jobname', jobName,
+                '-output-directory', args.quizDir,
+                templateFor(quizProblems(studentRecord))], env=formatEnvironment())
+            timing['status'] = 'timeout' if returncode is None else returncode
+        logFile = keepLog(args.quizDir, jobName)
+        # A PDF from an earlier run does not count.
+        pdfWritten = os.path.exists(pdfFile) and os.path.getmtime(pdfFile) >= compileStart - 1
+        if returncode == 0 and pdfWritten:
+            compileSamples.append((quizProblems(studentRecord), time.perf_counter() - startTime))
+        else:
+            reportFailure(studentRecord, texFailure(returncode, logFile))
+
+# The generated Questions.tex for a student as a string.
+def questionsText(studentRecord, blankHeader=False):
+    questions = io.StringIO()
+    writeQuestions(questions, studentRecord, blankHeader=blankHeader)
+    return questions.getvalue()
+
+# A manifest in args.quizDir remembers a hash of everything that went into
+# each quiz: the generated Questions.tex, the quiz template and the outcome
+# list. When a student's hash is unchanged and the PDF is still there, the
+# quiz is not compiled again (unless --force is given).
+def manifestPath():
+    return os.path.join(args.quizDir, 'manifest.json')
+
+def loadManifest():
+    if not os.path.exists(manifestPath()):
+        return dict()
+    with open(manifestPath(), 'r') as manifestFile:
+        return json.load(manifestFile)
+
+def saveManifest(manifest):
+    # Write a new file and then replace, so an interrupted run never leaves
+    # a damaged manifest behind.
+    with open(manifestPath() + '.tmp', 'w') as manifestFile:
+        json.dump(manifest, manifestFile, indent=1, sort_keys=True)
+    os.replace(manifestPath() + '.tmp', manifestPath())
+
+# Compile times are kept in args.quizDir as well, as an estimate of how long
+# pdflatex takes for the template itself (base) and for each problem (by
+# LaTeX stem), separately for full and --fragments compiles and for each
+# of them with --prunePreamble. After a run, half of the difference
+# between each measured and estimated time is shared out over the template
+# and the problems of that quiz, so the estimates follow the history of
+# runs. Problems never timed count as the average (and without any
+# history, quizzes with more problems count as longer).
+# With several jobs, the quizzes expected to take longest are started first,
+# so that one slow quiz is not left running alone at the end.
+compileSamples = []
+def timingsPath():
+    return os.path.join(args.quizDir, 'compiletimes.json')
+
+def timingsVariant():
+    variant = 'fragments' if args.fragments != '' else 'full'
+    return variant + '-pruned' if args.prunePreamble else variant
+
+def loadTimings():
+    allTimings = dict()
+    if os.path.exists(timingsPath()):
+        with open(timingsPath(), 'r') as timingsFile:
+            allTimings = json.load(timingsFile)
+    return allTimings.get(timingsVariant(), { 'base': 0.0, 'problems': dict() })
+
+def saveTimings(timings):
+    allTimings = dict()
+    if os.path.exists(timingsPath()):
+        with open(timingsPath(), 'r') as timingsFile:
+            allTimings = json.load(timingsFile)
+    allTimings[timingsVariant()] = timings
+    with open(timingsPath() + '.tmp', 'w') as timingsFile:
+        json.dump(allTimings, timingsFile, indent=1, sort_keys=True)
+    os.replace(timingsPath() + '.tmp', timingsPath())
+
+# The LaTeX stems of the problems on a student's quiz.
+def quizProblems(studentRecord):
+    return [ stem for stem, code in zip(activeStems, quizCodesOf(studentRecord)) if code != 0 ]
+
+def estimateSeconds(timings, problems):
+    known = timings['problems']
+    average = sum(known.values()) / len(known) if len(known) > 0 else 1.0
+    return timings['base'] + sum([ known.get(stem, average) for stem in problems ])
+
+def learnTimings(timings, problems, seconds):
+    known = timings['problems']
+    if len(known) == 0:
+        # The very first time is shared out evenly.
+        timings['base'] = seconds / (len(problems) + 1)
+        for stem in problems:
+            known[stem] = timings['base']
+        return
+    average = sum(known.values()) / len(known)
+    share = 0.5 * (seconds - estimateSeconds(timings, problems)) / (len(problems) + 1)
+    timings['base'] = max(0.0, timings['base'] + share)
+    for stem in problems:
+        known[stem] = max(0.0, known.get(stem, average) + share)
+
+# Longest expected compile first.
+def longestFirst(studentRecords, timings):
+    return sorted(studentRecords, key=lambda record: -estimateSeconds(timings, quizProblems(record)))
+
+def sourceHash():
+    digest = hashlib.sha1()
+    for fileName in [args.quizInclude, args.outcomeFile]:
+        with open(fileName, 'rb') as sourceFile:
+            digest.update(sourceFile.read())
+    return digest.hexdigest()
+
+def quizHash(studentRecord, sourceDigest):
+    return hashlib.sha1((sourceDigest + questionsText(studentRecord)).encode()).hexdigest()
+
+# Quizzes compiled outside of the starting folder (--jobs, --combined, --dedupe) run
+# pdflatex from a scratch folder, so TEXINPUTS points back at the folder with
+# the quiz template and the folder where we were started. The folder of the
+# compile itself comes first, so each compile finds its own Questions.tex
+# and never one left behind in the starting folder by a sequential run.
+def texEnvironment():
+    texInputs = ['.', os.path.dirname(os.path.abspath(args.quizInclude)), os.getcwd()]
+    texEnv = formatEnvironment()
+    # The trailing separator keeps the default TeX search path.
+    texEnv['TEXINPUTS'] = os.pathsep.join(texInputs + [texEnv.get('TEXINPUTS', '')])
+    return texEnv
+
+# A quiz compiled in the starting folder searches for its files as it always
+# has, and only needs to find the cached format.
+def formatEnvironment():
+    texEnv = dict(os.environ)
+    if quizFormat != '':
+        texEnv['TEXFORMATS'] = os.pathsep.join([os.path.abspath(args.formatCache), texEnv.get('TEXFORMATS', '')])
+    return texEnv
+
+# With --formatCache, the quiz preamble (packages, pgfplots and every \obj
+# problem definition) is loaded once and dumped as a format file using the
+# mylatexformat package. Each quiz then starts from that format, and the
+# preamble in the template is skipped up to \begin{document}.
+# The format name includes a hash of the preamble and of the pdflatex version,
+# so editing the template or updating TeX builds a fresh format automatically.
+# Returns the format name, or '' if the format could not be built.
+quizFormat = ''
+def formatOptions():
+    if quizFormat == '':
+        return []
+    return ['-fmt', quizFormat]
+
+def preambleHash():
+    with open(quizTemplate, 'rb') as templateFile:
+        template = templateFile.read()
+    documentStart = template.find(b'\\begin{document}')
+    if documentStart >= 0:
+        template = template[:documentStart]
+    version = subprocess.run(['pdflatex', '--version'], stdout=subprocess.PIPE).stdout
+    return hashlib.sha1(version + template).hexdigest()[:16]
+
+def prepareFormat():
+    formatName = 'quiz-' + preambleHash()
+    formatFile = os.path.join(args.formatCache, formatName + '.fmt')
+    if os.path.exists(formatFile):
+        print('Using cached format', formatFile)
+        return formatName
+
+    # Build in a scratch folder and move the finished format into place,
+    # so nobody else ever sees a partially written file.
+    print('Building format', formatFile)
+    os.makedirs(args.formatCache, exist_ok=True)
+    scratchDir = tempfile.mkdtemp(prefix=formatName + '-')
+    returncode = runTeX(['pdflatex', '-ini'] + texOptions + [
+        '-jobname', formatName,
+        '-output-directory', scratchDir,
+        '&pdflatex', 'mylatexformat.ltx', os.path.abspath(quizTemplate)],
+        env=texEnvironment())
+    builtFile = os.path.join(scratchDir, formatName + '.fmt')
+    if returncode != 0 or not os.path.exists(builtFile):
+        print('Could not build the format (files kept in %s), compiling without it.' % scratchDir)
+        return ''
+    os.replace(builtFile, formatFile)
+    shutil.rmtree(scratchDir, ignore_errors=True)
+    return formatName
+
+# Every pdflatex run is unattended. With nonstopmode and halt-on-error, a
+# TeX error (a bad \obj stem, a stray character) ends that one run instead
+# of waiting at a prompt, and --timeout stops any run that still hangs.
+# The terminal output is dropped since the .log file has all of it.
+# Returns the exit status, or None when the run was stopped.
+texOptions = ['-interaction=nonstopmode', '-halt-on-error']
+def runTeX(command, **options):
+    try:
+        return subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                              timeout=args.timeout if args.timeout > 0 else None, **options).returncode
+    except subprocess.TimeoutExpired:
+        return None
+
+def texFailure(returncode, logFile):
+    if returncode is None:
+        problem = 'pdflatex stopped after %d s' % args.timeout
+    elif returncode == 0:
+        problem = 'pdflatex wrote no PDF'
+    else:
+        problem = 'pdflatex exit status %d' % returncode
+    if logFile is not None:
+        problem = problem + ', see ' + logFile
+    return problem
+
+# The log of every compile is kept as logs/<job>.log in args.quizDir.
+# Returns where it was put, or None if pdflatex left no log.
+def keepLog(outputDir, jobName):
+    builtLog = os.path.join(outputDir, jobName + '.log')
+    if not os.path.exists(builtLog):
+        return None
+    logDir = os.path.join(args.quizDir, 'logs')
+    os.makedirs(logDir, exist_ok=True)
+    logFile = os.path.join(logDir, jobName + '.log')
+    os.replace(builtLog, logFile)
+    return logFile
+
+# Run pdflatex on the quiz template inside a scratch folder that already
+# holds the Questions.tex file, keeping every output file in that folder.
+def runPdflatex(jobName, scratchDir, texEnv, templateName):
+    with profiler.timed('pdflatex', job=jobName) as timing:
+        returncode = runTeX(['pdflatex'] + texOptions + formatOptions() + [
+            '-jobname', jobName,
+            '-output-directory', scratchDir,
+            os.path.abspath(templateName)],
+            cwd=scratchDir, env=texEnv)
+        timing['status'] = 'timeout' if returncode is None else returncode
+    return returncode
+
+# Quizzes that could not be made in this run, by job name. They are written
+# to failed.json in args.quizDir at the end, so that --retryFailed can
+# compile just those again once the problem is fixed.
+failedQuizzes = dict()
+def reportFailure(studentRecord, problem):
+    print('FAILED', studentRecord.name + ':', problem)
+    failedQuizzes[studentRecord.getLastFirstTight().lower()] = { 'name': studentRecord.name, 'problem': problem }
+
+def failuresPath():
+    return os.path.join(args.quizDir, 'failed.json')
+
+def loadFailures():
+    if not os.path.exists(failuresPath()):
+        return dict()
+    with open(failuresPath(), 'r') as failuresFile:
+        return json.load(failuresFile)
+
+# The quiz template that pdflatex compiles. With --fragments this is replaced
+# by a lightweight version that places precompiled problems.
+quizTemplate = args.quizInclude
+
+# Find every \newcommand{\name}[n]{...} in the LaTeX source, matching braces
+# to find where each definition ends. The starred forms, \renewcommand,
+# \providecommand, \DeclareRobustCommand and \def\name#1{...} count as well.
+# Comments are blanked out first (keeping every position the same), so a
+# commented-out definition is not found, nor its braces counted.
+# Returns a dictionary from the command name (without the backslash) to
+# (start, end, number of arguments).
+commentPattern = re.compile(r'(?<!\\)((?:\\\\)*)%[^\n]*')
+def blankComments(source):
+    return commentPattern.sub(lambda matches: matches.group(1) + ' ' * (len(matches.group(0)) - len(matches.group(1))), source)
+
+newCommandPattern = re.compile(r'\\(?:(?:new|renew|provide)command|DeclareRobustCommand)\*?\s*\{?\\([A-Za-z]+)\}?\s*(?:\[([0-9])\](?:\s*\[[^\]]*\])?)?\s*\{'
+                               r'|\\[egx]?def\s*\\([A-Za-z]+)((?:#[0-9])*)\s*\{')
+def findNewCommands(source):
+    source = blankComments(source)
+    commands = dict()
+    position = 0
+    while True:
+        matches = newCommandPattern.search(source, position)
+        if matches is None:
+            return commands
+        depth = 0
+        k = matches.end() - 1
+        while k < len(source):
+            c = source[k]
+            if c == '\\':
+                k = k + 1
+            elif c == '%':
+                k = source.find('\n', k)
+                if k < 0:
+                    k = len(source)
+            elif c == '{':
+                depth = depth + 1
+            elif c == '}':
+                depth = depth - 1
+                if depth == 0:
+                    break
+            k = k + 1
+        if matches.group(3):
+            numArgs = matches.group(4).count('#')
+            commands[matches.group(3)] = (matches.start(), k+1, numArgs)
+        else:
+            numArgs = int(matches.group(2)) if matches.group(2) else 0
+            commands[matches.group(1)] = (matches.start(), k+1, numArgs)
+        position = k+1
+
+# Split the quiz template at \begin{document}.
+def readTemplate(templateName=None):
+    with open(templateName or args.quizInclude, 'r') as templateFile:
+        template = templateFile.read()
+    documentStart = template.find('\\begin{document}')
+    return template[:documentStart], template[documentStart:]
+
+# With --fragments, each problem of the active outcomes is compiled once into
+# a small cropped PDF (using the preview package) and cached in the folder.
+# A problem taking an argument gets two fragments, plain and with ' (A)',
+# while for a problem with no argument the (A) still follows as text.
+# A fragment's file name is a hash of the problem's source and of the rest
+# of the preamble without any \newcommand (packages and page layout), so
+# editing the header or one problem only rebuilds what changed.
+# The quizzes are then compiled from a lightweight copy of the template
+# where each of these problems just places its fragment, and where pgfplots
+# and tikz are not even loaded if nothing left in the preamble draws.
+# The Questions.tex files are the same, so this works with every other mode.
+fragmentVariants = { 0: [''], 1: ['', ' (A)'] }
+heavyPackagePattern = re.compile(r'^\s*\\(usepackage\{(pgfplots|tikz)\}|pgfplotsset|usetikzlibrary).*$', re.MULTILINE)
+drawingPattern = re.compile(r'\\(begin\{(tikzpicture|axis)\}|tikz\b|addplot)')
+def fragmentFile(key):
+    return os.path.join(os.path.abspath(args.fragments), 'problem-' + key + '.pdf')
+
+def prepareFragments():
+    preamble, body = readTemplate()
+    commands = findNewCommands(preamble)
+
+    # The layout part of the preamble is everything except the definitions.
+    setup = preamble
+    for name in sorted(commands, key=lambda name: -commands[name][0]):
+        start, end, numArgs = commands[name]
+        setup = setup[:start] + setup[end:]
+    setupHash = hashlib.sha1(setup.encode()).hexdigest()
 
-# Parse the restricted set of outcomes that will be included.
+    # Decide on a fragment for every variant of the problems in use.
+    fragmentKeys = dict()
+    for outcomeRow in useOutcomes:
+        name = 'obj' + outcomeRow[2]
+        if name not in commands or commands[name][2] not in fragmentVariants:
+            continue
+        start, end, numArgs = commands[name]
+        fragmentKeys[name] = [ hashlib.sha1((setupHash + preamble[start:end] + variant).encode()).hexdigest()[:20]
+                               for variant in fragmentVariants[numArgs] ]
+
+    # Compile all missing fragments in one run, one page per fragment.
+    os.makedirs(args.fragments, exist_ok=True)
+    missing = [ (name, variant, key) for name in sorted(fragmentKeys)
+                for variant, key in zip(fragmentVariants[commands[name][2]], fragmentKeys[name])
+                if not os.path.exists(fragmentFile(key)) ]
+    if len(missing) > 0:
+        print('Compiling %d problem fragments.' % len(missing))
+        scratchDir = tempfile.mkdtemp(prefix='fragments-')
+        with open(os.path.join(scratchDir, 'fragments.tex'), 'w') as fragmentTex:
+            fragmentTex.write(preamble)
+            fragmentTex.write('\\usepackage[active,tightpage]{preview}\n')
+            fragmentTex.write('\\begin{document}\n\\pagestyle{empty}\n')
+            for name, variant, key in missing:
+                fragmentTex.write('\\begin{preview}\\begin{minipage}{\\textwidth}\\begin{enumerate}\n')
+                fragmentTex.write('\\%s{%s}\n' % (name, variant) if commands[name][2] > 0 else '\\%s\n' % name)
+                fragmentTex.write('\\end{enumerate}\\end{minipage}\\end{preview}\n')
+            fragmentTex.write('\\end{document}\n')
+        returncode = runTeX(['pdflatex'] + texOptions + ['-output-directory', scratchDir,
+            os.path.join(scratchDir, 'fragments.tex')],
+            cwd=scratchDir, env=texEnvironment())
+        pdfFile = os.path.join(scratchDir, 'fragments.pdf')
+        if returncode != 0 or not os.path.exists(pdfFile):
+            print('Could not compile the fragments (files kept in %s), using the full template.' % scratchDir)
+            return args.quizInclude
+        for page, (name, variant, key) in enumerate(missing):
+            # Write under a temporary name so a partial file is never used
+            # (named by process, as several runs may share the cache).
+            partialFile = '%s.%d.tmp' % (fragmentFile(key), os.getpid())
+            process = subprocess.run(['qpdf', '--empty', '--pages', pdfFile, str(page+1), '--', partialFile])
+            if process.returncode != 0:
+                print('Could not split the fragments (files kept in %s), using the full template.' % scratchDir)
+                return args.quizInclude
+            os.replace(partialFile, fragmentFile(key))
+        shutil.rmtree(scratchDir, ignore_errors=True)
+
+    # Replace each fragment problem by a command placing its image, lined up
+    # with the left edge of the text like the original enumerate item.
+    # Problems that are not in use this week are left out altogether.
+    activeNames = set([ 'obj' + outcomeRow[2] for outcomeRow in useOutcomes ] + ['objMastery'])
+    lightPreamble = preamble
+    for name in sorted(commands, key=lambda name: -commands[name][0]):
+        start, end, numArgs = commands[name]
+        if name in fragmentKeys:
+            keys = fragmentKeys[name]
+            if numArgs == 0:
+                definition = '\\newcommand{\\%s}{\\quizfragment{%s}}' % (name, fragmentFile(keys[0]))
+            else:
+                definition = '\\newcommand{\\%s}[1]{\\quizfragmentA{%s}{%s}{#1}}' % (name, fragmentFile(keys[0]), fragmentFile(keys[1]))
+        elif name.startswith('obj') and name not in activeNames:
+            definition = ''
+        else:
+            continue
+        lightPreamble = lightPreamble[:start] + definition + lightPreamble[end:]
+    if drawingPattern.search(heavyPackagePattern.sub('', lightPreamble)) is None:
+        lightPreamble = heavyPackagePattern.sub('', lightPreamble)
+    lightPreamble = lightPreamble + '\n'.join([
+        '\\usepackage{graphicx}',
+        '\\newcommand{\\quizfragment}[1]{\\item[]\\hspace*{-\\leftmargin}\\includegraphics{#1}}',
+        '\\newcommand{\\quizfragmentA}[3]{\\if\\relax\\detokenize{#3}\\relax\\quizfragment{#1}\\else\\quizfragment{#2}\\fi}',
+        '', ''])
+
+    lightTemplate = lightPreamble + body
+    templateName = 'quiz-' + hashlib.sha1(lightTemplate.encode()).hexdigest()[:16] + '.tex'
+    templateFile = os.path.join(os.path.abspath(args.fragments), templateName)
+    with open('%s.%d.tmp' % (templateFile, os.getpid()), 'w') as lightFile:
+        lightFile.write(lightTemplate)
+    os.replace('%s.%d.tmp' % (templateFile, os.getpid()), templateFile)
+    print('Using %d problem fragments.' % sum([ len(keys) for keys in fragmentKeys.values() ]))
+    return templateFile
+
+# The problem index of a quiz template: every command it defines, by name
+# (without the backslash), as (start, end, number of arguments, packages),
+# where start and end locate the definition in the preamble and packages
+# are the drawing packages (tikz, pgfplots) its body relies on.
+# The template is indexed once, and every outcome in use is checked against
+# it before anything is compiled, so a missing or misspelled \obj command
+# stops the run at once instead of failing every quiz that asks for it.
+drawingPackages = [ ('pgfplots', re.compile(r'\\(begin\{axis\}|addplot)')),
+                    ('tikz', re.compile(r'\\(begin\{tikzpicture\}|tikz\b)')) ]
+def indexTemplate(templateName):
+    preamble, body = readTemplate(templateName)
+    index = dict()
+    for name, (start, end, numArgs) in findNewCommands(preamble).items():
+        packages = tuple([ package for package, pattern in drawingPackages if pattern.search(preamble, start, end) ])
+        index[name] = (start, end, numArgs, packages)
+    return preamble, body, index
+
+# Problems are written as \objStem{} or \objStem{ (A)} (see writeQuestions),
+# so each needs a definition taking at most one argument. A command that
+# appears in the preamble without a definition found above (say, from
+# \NewDocumentCommand or \let) is left for pdflatex to check, with a warning.
+def mentions(preamble, name):
+    return re.search(r'\\' + name + r'(?![A-Za-z])', blankComments(preamble)) is not None
+
+def checkTemplate(index, preamble):
+    problems = []
+    for name in ['header', 'objMastery']:
+        if name not in index and mentions(preamble, name):
+            print('Warning: could not find how \\%s is defined, so it is not checked' % name)
+        elif name not in index:
+            problems.append('\\%s is not defined' % name)
+    for outcomeRow in useOutcomes:
+        name = 'obj' + outcomeRow[2]
+        code = getOutcomeCode(outcomeRow[0], outcomeRow[1])
+        if not outcomeRow[2].isalpha():
+            problems.append('%s: the stem %s can only use letters' % (code, outcomeRow[2]))
+        elif name not in index and mentions(preamble, name):
+            print('Warning: %s: could not find how \\%s is defined, so it is not checked' % (code, name))
+        elif name not in index:
+            problems.append('%s: \\%s is not defined' % (code, name))
+        elif index[name][2] > 1:
+            problems.append('%s: \\%s takes %d arguments, at most 1 is used' % (code, name, index[name][2]))
+    if len(problems) > 0:
+        raise SystemExit('The quiz template %s does not match the outcome list:\n  %s'
+                         % (args.quizInclude, '\n  '.join(problems)))
+
+# With --prunePreamble, each compile gets a copy of the template with only
+# the problem definitions its quiz uses (the other commands stay). When
+# none of what is left draws anything, pgfplots and tikz are not loaded
+# either, which is most of the time pdflatex spends on the preamble.
+# Quizzes with the same problems share one file, kept in templates/ in
+# args.quizDir and named by a hash of its contents.
+prunedIndex = None
+def prunedTemplate(problems):
+    preamble, body, index = prunedIndex
+    problems = set(problems)
+    keep = [ name for name in index if not name.startswith('obj') or name[3:] in problems or name == 'objMastery' ]
+    pruned = preamble
+    setup = preamble
+    for name in sorted(index, key=lambda name: -index[name][0]):
+        start, end, numArgs, packages = index[name]
+        setup = setup[:start] + setup[end:]
+        if name not in keep:
+            pruned = pruned[:start] + pruned[end:]
+    needsDrawing = any([ len(index[name][3]) > 0 for name in keep ])
+    if not needsDrawing and drawingPattern.search(heavyPackagePattern.sub('', setup)) is None:
+        pruned = heavyPackagePattern.sub('', pruned)
+    template = pruned + body
+    templateDir = os.path.join(os.path.abspath(args.quizDir), 'templates')
+    templateFile = os.path.join(templateDir, 'quiz-' + hashlib.sha1(template.encode()).hexdigest()[:16] + '.tex')
+    if not os.path.exists(templateFile):
+        # Written under a temporary name, as other workers may want it too.
+        os.makedirs(templateDir, exist_ok=True)
+        handle, partialFile = tempfile.mkstemp(dir=templateDir, suffix='.tmp')
+        with os.fdopen(handle, 'w') as prunedFile:
+            prunedFile.write(template)
+        os.replace(partialFile, templateFile)
+    return templateFile
+
+def templateFor(problems):
+    if not args.prunePreamble:
+        return quizTemplate
+    return prunedTemplate(problems)
+
+# With --jobs, every quiz gets its own scratch folder holding its own
+# Questions.tex, so several pdflatex runs can share the machine without
+# overwriting each other's files (including the Questions.aux from \include).
+# The worker only waits on pdflatex, so threads are enough to keep every
+# core busy. The finished PDF is moved into args.quizDir.
+# Returns None on success, otherwise a message describing the failure.
+# Given the problems on the quiz, the compile time is kept for the estimates.
+def compileInScratch(jobName, questions, texEnv, outFile, problems=None):
+    scratchDir = tempfile.mkdtemp(prefix=jobName + '-')
+    with open(os.path.join(scratchDir, 'Questions.tex'), 'w') as quizFile:
+        quizFile.write(questions)
+    startTime = time.perf_counter()
+    returncode = runPdflatex(jobName, scratchDir, texEnv, templateFor(problems or []))
+    logFile = keepLog(scratchDir, jobName)
+    pdfFile = os.path.join(scratchDir, jobName + '.pdf')
+    if returncode != 0 or not os.path.exists(pdfFile):
+        return '%s (files kept in %s)' % (texFailure(returncode, logFile), scratchDir)
+    if problems is not None:
+        compileSamples.append((problems, time.perf_counter() - startTime))
+    shutil.move(pdfFile, outFile)
+    shutil.rmtree(scratchDir, ignore_errors=True)
+    return None
+
+def compileQuizInScratch(studentRecord, texEnv):
+    jobName = studentRecord.getLastFirstTight().lower()
+    with profiler.timed('quiz', job=jobName) as timing:
+        problem = compileInScratch(jobName, questionsText(studentRecord), texEnv,
+                                   os.path.join(args.quizDir, jobName + '.pdf'),
+                                   quizProblems(studentRecord))
+        timing['status'] = 'ok' if problem is None else 'failed'
+    return problem
+
+# Compile all of the quizzes using a pool of args.jobs workers.
+# A failed quiz is reported but does not stop the rest of the batch.
+# The longest quizzes are started first, but the results are still
+# reported in the order of studentRecords.
+def generateQuizzesInParallel(studentRecords):
+    texEnv = texEnvironment()
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = dict()
+        for record in longestFirst(studentRecords, compileTimings):
+            futures[record] = pool.submit(compileQuizInScratch, record, texEnv)
+        for record in studentRecords:
+            future = futures[record]
+            try:
+                problem = future.result()
+            except Exception as err:
+                problem = str(err)
+            if problem is None:
+                print('Compiled', record.getLastFirstTight().lower())
+            else:
+                reportFailure(record, problem)
+
+# With --combined, every quiz goes into a single Questions.tex and pdflatex
+# only starts (and loads the preamble) once. Each quiz starts on a fresh
+# page and ends with \cleardoublepage, and where it starts is written to
+# the .aux file as an absolute page number (the abspage counter of LaTeX
+# 2020-10 or later), so blank pages added by \cleardoublepage in a twoside
+# template go with the quiz before them. The numbers are read back, and qpdf
+# cuts the combined PDF from the start of one quiz to the next, into one
+# file per student.
+# The combined PDF is kept in args.quizDir as allquizzes.pdf for printing.
+quizStartPattern = re.compile(r'\\newlabel\{quizstart:([0-9]+)\}\{\{[^{}]*\}\{([0-9]+)\}')
+def readQuizStartPages(auxFiles):
+    startPages = dict()
+    for auxFile in auxFiles:
+        if not os.path.exists(auxFile):
+            continue
+        with open(auxFile, 'r') as auxStream:
+            for line in auxStream:
+                matches = quizStartPattern.match(line)
+                if matches:
+                    startPages[int(matches.group(1))] = int(matches.group(2))
+    return startPages
+
+def generateCombinedQuizzes(studentRecords):
+    jobName = 'allquizzes'
+    scratchDir = tempfile.mkdtemp(prefix=jobName + '-')
+    with open(os.path.join(scratchDir, 'Questions.tex'), 'w') as quizFile:
+        for k, record in enumerate(studentRecords):
+            writeQuestions(quizFile, record, 'quizstart:%d' % k)
+    problems = set([ stem for record in studentRecords for stem in quizProblems(record) ])
+    returncode = runPdflatex(jobName, scratchDir, texEnvironment(), templateFor(problems))
+    logFile = keepLog(scratchDir, jobName)
+    pdfFile = os.path.join(scratchDir, jobName + '.pdf')
+    if returncode != 0 or not os.path.exists(pdfFile):
+        problem = '%s (files kept in %s)' % (texFailure(returncode, logFile), scratchDir)
+        print('FAILED combined quiz:', problem)
+        for record in studentRecords:
+            failedQuizzes[record.getLastFirstTight().lower()] = { 'name': record.name, 'problem': problem }
+        return
+    startPages = readQuizStartPages([os.path.join(scratchDir, 'Questions.aux'),
+                                     os.path.join(scratchDir, jobName + '.aux')])
+    combinedFile = os.path.join(args.quizDir, jobName + '.pdf')
+    shutil.move(pdfFile, combinedFile)
+    counted = subprocess.run(['qpdf', '--show-npages', combinedFile], stdout=subprocess.PIPE)
+    numPages = int(counted.stdout) if counted.returncode == 0 else 0
+    startPages[len(studentRecords)] = numPages + 1
+
+    for k, record in enumerate(studentRecords):
+        outFile = record.getLastFirstTight().lower() + '.pdf'
+        if k not in startPages or k+1 not in startPages or startPages[k+1] <= startPages[k]:
+            reportFailure(record, 'no page range found (needs LaTeX 2020-10 or later), files kept in ' + scratchDir)
+            continue
+        firstPage = startPages[k]
+        lastPage = startPages[k+1] - 1
+        with profiler.timed('qpdf', job=outFile) as timing:
+            process = subprocess.run(['qpdf', '--empty',
+                '--pages', combinedFile, '%d-%d' % (firstPage, lastPage), '--',
+                os.path.join(args.quizDir, outFile)])
+            timing['status'] = process.returncode
+        if process.returncode != 0:
+            reportFailure(record, 'qpdf exit status %d' % process.returncode)
+        else:
+            print('Split', outFile, 'pages %d-%d' % (firstPage, lastPage))
+
+    if len(failedQuizzes) == 0:
+        shutil.rmtree(scratchDir, ignore_errors=True)
+
+# With --dedupe, students with exactly the same problems (same mastered
+# list, same unmastered problems, same (A) marks) share one compiled quiz.
+# Each distinct set of problems is compiled once with an empty \markright.
+# The names are then typeset all together in one more pdflatex run: one
+# page per student holding only the running head, with page numbers blanked
+# out so they do not print over the ones in the quiz. qpdf overlays page k
+# of that file onto every page of the k-th student's copy of their quiz.
+def generateDeduplicatedQuizzes(studentRecords):
+    texEnv = texEnvironment()
+    bodyDir = tempfile.mkdtemp(prefix='quizbodies-')
+
+    # Group students by the text of their quiz without the name.
+    bodies = dict()
+    for record in studentRecords:
+        body = questionsText(record, blankHeader=True)
+        bodies.setdefault(body, []).append(record)
+    print('%d distinct quizzes for %d students.' % (len(bodies), len(studentRecords)))
+
+    # Compile each distinct quiz once, longest expected compile first.
+    bodyFiles = dict()
+    bodyProblems = dict()
+    problemStems = dict([ (body, quizProblems(records[0])) for body, records in bodies.items() ])
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = dict()
+        bodyNames = dict()
+        for k, body in enumerate(bodies):
+            bodyNames[body] = 'quizbody%d' % k
+            bodyFiles[body] = os.path.join(bodyDir, bodyNames[body] + '.pdf')
+        for body in sorted(bodies, key=lambda body: -estimateSeconds(compileTimings, problemStems[body])):
+            futures[body] = pool.submit(compileInScratch, bodyNames[body], body, texEnv,
+                                        bodyFiles[body], problemStems[body])
+        for body in bodies:
+            try:
+                bodyProblems[body] = futures[body].result()
+            except Exception as err:
+                bodyProblems[body] = str(err)
+
+    # Typeset every name header in one run.
+    stamps = io.StringIO()
+    stamps.write('\\renewcommand{\\thepage}{}\n')
+    for record in studentRecords:
+        writeHeader(stamps, record)
+        stamps.write('\\null\\clearpage\n\n')
+    stampFile = os.path.join(bodyDir, 'quiznames.pdf')
+    stampProblem = compileInScratch('quiznames', stamps.getvalue(), texEnv, stampFile)
+
+    for k, record in enumerate(studentRecords):
+        body = questionsText(record, blankHeader=True)
+        problem = bodyProblems[body] or stampProblem
+        outFile = record.getLastFirstTight().lower() + '.pdf'
+        if problem is None:
+            with profiler.timed('qpdf', job=outFile) as timing:
+                process = subprocess.run(['qpdf', bodyFiles[body],
+                    '--overlay', stampFile, '--from=%d' % (k+1), '--repeat=%d' % (k+1), '--',
+                    os.path.join(args.quizDir, outFile)])
+                timing['status'] = process.returncode
+            if process.returncode != 0:
+                problem = 'qpdf exit status %d' % process.returncode
+        if problem is None:
+            print('Stamped', outFile)
+        else:
+            reportFailure(record, problem)
+    shutil.rmtree(bodyDir, ignore_errors=True)
+
+# Here is where the real work takes place.
+# First parse the restricted set of outcomes that will be included, so that
+# only their columns need to be read from the mastery export.
 # This is reading the tab-delimited text file summarizing outcome information.
 # GroupCode \t OutcomeCode \t LateX_stem \t Week_Introduced
 # An example line might be as follows
@@ -251,23 +840,174 @@ with open(args.outcomeFile, 'r') as outcomeFile:
             useOutcomeDict[objCode] = len(useOutcomes)
             outcomeStats[objCode] = [0, 0] # pass/not yet
             useOutcomes.append(row)
+# Check that the quiz template defines every problem before going further.
+templateIndex = indexTemplate(args.quizInclude)
+checkTemplate(templateIndex[2], templateIndex[0])
+profiler.lap('outcomes', len(useOutcomes))
+
+# Then load the file containing mastery data from Canvas report export.
+# Parse the data file to create our desired information
+# With --store, the export was already loaded by mastery-import.py.
+store = None
+if args.store != '':
+    store = MasteryStore(args.store, args.snapshot)
+    headers = store.readMasteryHeader()
+else:
+    masteryFile = open(args.csvFile, newline='')
+    # Create an iterator to go through the rows on the file.
+    dataStream = csv.reader(masteryFile)
+
+    # The first row has header information
+    # Read and then parse this information into something useful for us.
+    headers = next(dataStream)
+numberOutcomes = (len(headers)-2)//2
+groups, outcomeArray, outcomeDict = parseOutcomeHeader(headers)
+
+# Only the columns of the included outcomes are read from the rest of the file.
+usedIndices = set([ outcomeDict[code].index for code in useOutcomeDict if code in outcomeDict ])
+scoreMatrix = ScoreMatrix(sorted(usedIndices))
+
+# All other rows are individual student records
+if store is not None:
+    studentData = [ parseRow(name, id, row) for name, id, row in store.readMasteryRows(scoreMatrix) ]
+else:
+    studentData = [ parseRow(name, id, row) for name, id, row in readMasteryRows(dataStream, scoreMatrix) ]
+    masteryFile.close()
+
+# The template quiz uses a blank row, added before the mastery is worked out.
+blankStudent = BlankStudent(numberOutcomes)
+# Mastery here means reaching args.doneScore, worked out for everyone at once.
+masteredMask = scoreMatrix.masteryMask(args.doneScore)
+
+# The outcomes in use are fixed for the run, so they are looked up once: the
+# matrix column, outcome code and LaTeX stem of each, in the order of the
+# outcome list. Then one pass over the matrix says, for every student and
+# outcome, whether it is mastered, a problem or an apprentice level problem.
+activeColumns = [ scoreMatrix.column[outcomeDict[getOutcomeCode(row[0], row[1])].index] for row in useOutcomes ]
+activeCodes = [ outcomeDict[getOutcomeCode(row[0], row[1])].outcomeCode for row in useOutcomes ]
+activeStems = [ row[2] for row in useOutcomes ]
+if len(activeColumns) > 1:
+    pickColumns = operator.itemgetter(*activeColumns)
+    pickActive = lambda codes: bytes(pickColumns(codes))
+else:
+    pickActive = lambda codes: bytes([ codes[column] for column in activeColumns ])
+studentQuizCodes = scoreMatrix.quizCodes(masteredMask, args.apprenticeScore)
+profiler.lap('mastery', len(studentData))
+
+# Next, read information about students and which sections they are in.
+# It gets printed in the header for convenience on paper copies
+# Parse the student data file to organize the printing
+# The store always has the gradebook, joined to the mastery export on IDs.
+useSections = (args.studentData != '' or store is not None)
+studentSections = dict()
+if store is not None:
+    studentSections = store.readMasterySections()
+    store.close()
+elif (args.studentData != ''):
+    with open(args.studentData, newline='') as studentInfoFile:
+        # Create an iterator to go through the rows on the file.
+        dataStream = csv.reader(studentInfoFile)
+
+        # The first row has header information
+        # Read and then parse this information into something useful for us.
+        headers = next(dataStream)
+        for student in dataStream:
+            name = student[0]
+            section = student[4]
+            studentSections[name] = section
 
 # We will generate the quizzes in student order
 # Create a sort order for students base on LastName, FirstName
 def nameKey(i):
     return studentData[i].getLastFirst()
 def sectionNameKey(i):
-    section = studentSections[studentData[i].name]
+    section = studentSections.get(studentData[i].name, "Both")
     return section + studentData[i].getLastFirst()
 numStudents = len(studentData)
 nameOrder = sorted([i for i in range(numStudents)], key=nameKey)
 
 order = nameOrder
-if (args.studentData != ''):
+if useSections:
     print("Using sections for sorting.")
     order = sorted([i for i in range(numStudents)], key=sectionNameKey)
 
-for i in order:
-    generateQuiz(studentData[i])
+profiler.lap('sections and order', len(order))
+
+if args.fragments != '':
+    quizTemplate = prepareFragments()
+    profiler.lap('fragments')
+
+if args.formatCache != '':
+    quizFormat = prepareFormat()
+    profiler.lap('format')
+
+# A format already holds the whole preamble, so there is nothing to prune.
+if args.prunePreamble and quizFormat != '':
+    print('The preamble comes from the format, so --prunePreamble is not used.')
+    args.prunePreamble = False
+if args.prunePreamble:
+    prunedIndex = templateIndex if quizTemplate == args.quizInclude else indexTemplate(quizTemplate)
+
 # The template quiz will be generated last.
-generateQuiz(BlankStudent(numberOutcomes))
+quizRecords = [studentData[i] for i in order] + [blankStudent]
+
+# With --retryFailed, only the quizzes that failed last time are compiled,
+# whether or not they look up to date.
+if args.retryFailed:
+    previousFailures = loadFailures()
+    quizRecords = [ record for record in quizRecords if record.getLastFirstTight().lower() in previousFailures ]
+    print('Retrying %d quizzes that failed in the previous run.' % len(quizRecords))
+
+# Skip the quizzes that have not changed since they were last compiled.
+manifest = loadManifest()
+compileTimings = loadTimings()
+sourceDigest = sourceHash()
+quizHashes = dict()
+changedRecords = []
+for record in quizRecords:
+    jobName = record.getLastFirstTight().lower()
+    quizHashes[jobName] = quizHash(record, sourceDigest)
+    pdfExists = os.path.exists(os.path.join(args.quizDir, jobName + '.pdf'))
+    if args.force or args.retryFailed or not pdfExists or manifest.get(jobName) != quizHashes[jobName]:
+        changedRecords.append(record)
+print('%d of %d quizzes need to be compiled.' % (len(changedRecords), len(quizRecords)))
+profiler.lap('manifest', len(quizRecords))
+
+startTime = time.time()
+if len(changedRecords) == 0:
+    print('Every quiz is up to date, use --force to compile them again.')
+elif args.combined:
+    generateCombinedQuizzes(changedRecords)
+elif args.dedupe:
+    generateDeduplicatedQuizzes(changedRecords)
+elif args.jobs > 1:
+    generateQuizzesInParallel(changedRecords)
+else:
+    for record in changedRecords:
+        generateQuiz(record)
+profiler.lap('compile', len(changedRecords))
+
+# Only quizzes whose PDF was written by this run are recorded as done.
+for record in changedRecords:
+    jobName = record.getLastFirstTight().lower()
+    pdfFile = os.path.join(args.quizDir, jobName + '.pdf')
+    if jobName not in failedQuizzes and os.path.exists(pdfFile) and os.path.getmtime(pdfFile) >= startTime - 1:
+        manifest[jobName] = quizHashes[jobName]
+saveManifest(manifest)
+# Keep the list of failures for --retryFailed, or clear it when all went well.
+if len(failedQuizzes) > 0:
+    with open(failuresPath(), 'w') as failuresFile:
+        json.dump(failedQuizzes, failuresFile, indent=1, sort_keys=True)
+    failedNames = [ failure['name'] for failure in failedQuizzes.values() ]
+    if len(failedNames) > 10:
+        failedNames = failedNames[:10] + ['and %d more' % (len(failedNames) - 10)]
+    print('%d of %d quizzes failed: %s' % (len(failedQuizzes), len(changedRecords), ', '.join(failedNames)))
+    print('Details are in %s, rerun with --retryFailed once they are fixed.' % failuresPath())
+elif os.path.exists(failuresPath()):
+    os.remove(failuresPath())
+# Improve the compile time estimates with the times measured in this run.
+if len(compileSamples) > 0:
+    for problems, seconds in compileSamples:
+        learnTimings(compileTimings, problems, seconds)
+    saveTimings(compileTimings)
+profiler.close()
@@ -0,0 +1,100 @@
+import argparse
+import fnmatch
+import os
+import shlex
+import subprocess
+import sys
+import time
+from masterystore import MasteryStore
+
+# Keep watching the folder where the Canvas exports are downloaded, and
+# bring the quizzes (and optionally the reports) up to date as soon as a new
+# gradebook or mastery export lands there.
+# Each new pair of exports is imported into the store as its own snapshot,
+# labelled with the time of the newer file (e.g. "2020-06-01 14:05:09"),
+# and compared with the previous one. When only one of the two files is new,
+# only that one is parsed, and the other half of the previous snapshot is
+# copied over in the store. mastery-quizzes.py and progress-reports.py then
+# run from the store: the quizzes whose content changed (see the quiz
+# manifest), and with --changedOnly the reports of just the students whose
+# mastery changed. What is expensive to rebuild stays warm on disk between
+# runs: the quiz manifest and compile times, and a --formatCache or
+# --fragments folder if given in the quiz options, so a new export only
+# costs the compiles it really needs.
+# A file is used once it has not been modified for --settle seconds, so a
+# download still in progress is left alone.
+
+parser = argparse.ArgumentParser(description='Watch a folder for new Canvas exports and update the quizzes and reports.')
+parser.add_argument('--dropDir', default='.', help='folder path, where the Canvas exports are downloaded')
+parser.add_argument('--store', help='file path, SQLite store the exports are imported into (created if needed)')
+parser.add_argument('--gradesPattern', default='*grades*.csv', help='text, file name pattern of gradebook exports (ignoring case)')
+parser.add_argument('--masteryPattern', default='*mastery*.csv', help='text, file name pattern of learning mastery exports (ignoring case)')
+parser.add_argument('--interval', type=float, default=30, help='number, seconds between looks at the folder')
+parser.add_argument('--settle', type=float, default=5, help='number, seconds a file must be left unchanged before it is used')
+parser.add_argument('--quizzes', default='', help='text, options for mastery-quizzes.py (without --store), e.g. "--outcomes OutcomeList.txt --quiz Quiz.tex --quizDir quizzes/ --jobs 4"')
+parser.add_argument('--reports', default='', help='text, options for progress-reports.py (without --store), or empty to not run it')
+parser.add_argument('--once', action='store_true', help='flag, handle the exports already in the folder and stop instead of watching')
+args = parser.parse_args()
+if args.quizzes == '' and args.reports == '':
+    parser.error('give the options of the scripts to run with --quizzes and/or --reports')
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+# The newest export matching the pattern, or None.
+def newestExport(pattern):
+    exports = [ os.path.join(args.dropDir, fileName) for fileName in os.listdir(args.dropDir)
+                if fnmatch.fnmatch(fileName.lower(), pattern.lower()) ]
+    return max(exports, key=os.path.getmtime, default=None)
+
+def runScript(script, options, storeOptions=[]):
+    command = [sys.executable, os.path.join(scriptDir, script), '--store', args.store] + storeOptions + shlex.split(options)
+    print('Running', ' '.join([ shlex.quote(part) for part in command ]), flush=True)
+    process = subprocess.run(command)
+    if process.returncode != 0:
+        print('%s exited with status %d' % (script, process.returncode))
+
+# Import a new pair of exports, unless it is already in the store (e.g. when
+# the watch is restarted), and update everything that depends on it.
+# imported remembers each file (with its time) as it went into the store,
+# so a file that is still the same is not parsed again.
+imported = { 'grades': None, 'mastery': None }
+def handleExports(store, gradesFile, masteryFile):
+    newest = max(os.path.getmtime(gradesFile), os.path.getmtime(masteryFile))
+    label = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(newest))
+    if label in store.importDates():
+        return
+    startTime = time.perf_counter()
+    current = { 'grades': (gradesFile, os.path.getmtime(gradesFile)),
+                'mastery': (masteryFile, os.path.getmtime(masteryFile)) }
+    newFiles = dict([ (kind, current[kind][0] if current[kind] != imported[kind] else None) for kind in current ])
+    importDate, numRoster, numMastery = store.importExports(newFiles['grades'], newFiles['mastery'], label)
+    imported.update(current)
+    print('Snapshot %s: %d students in %s, %d in %s.' % (importDate,
+          numRoster, os.path.basename(gradesFile) + ('' if newFiles['grades'] else ' (unchanged)'),
+          numMastery, os.path.basename(masteryFile) + ('' if newFiles['mastery'] else ' (unchanged)')))
+    changes = store.changedOutcomes()
+    if changes is not None:
+        print('%d students changed since the previous snapshot.' % len(changes))
+        if len(changes) == 0:
+            return
+    if args.quizzes != '':
+        runScript('mastery-quizzes.py', args.quizzes)
+    if args.reports != '':
+        runScript('progress-reports.py', args.reports, ['--changedOnly'])
+    print('Snapshot %s done in %.1f s.' % (importDate, time.perf_counter() - startTime))
+
+store = MasteryStore(args.store)
+try:
+    while True:
+        gradesFile = newestExport(args.gradesPattern)
+        masteryFile = newestExport(args.masteryPattern)
+        if gradesFile is not None and masteryFile is not None:
+            newest = max(os.path.getmtime(gradesFile), os.path.getmtime(masteryFile))
+            if args.once or time.time() - newest >= args.settle:
+                handleExports(store, gradesFile, masteryFile)
+        if args.once:
+            break
+        time.sleep(args.interval)
+except KeyboardInterrupt:
+    print('Stopped watching', args.dropDir)
+store.close()
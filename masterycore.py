@@ -0,0 +1,193 @@
+# Shared pieces for the mastery scripts.
+# The scripts are run directly (python3 mastery-quizzes.py ...), and Python
+# puts the folder of the script on the import path, so this file only needs
+# to sit next to them.
+
+from array import array
+from itertools import repeat
+import operator
+
+# Swaps the 0 and 1 bytes of a mask.
+flipTable = bytes([1, 0] + list(range(2, 256)))
+
+# Some structure to keep track of outcomes, organized by groups.
+# Courses have a few dozen outcomes but records are made for every student,
+# so both kinds of record use __slots__ rather than a dictionary each.
+class Outcome:
+    __slots__ = ('groupCode', 'groupTitle', 'outcomeCode', 'outcomeTitle', 'index')
+    def __init__(self, groupCode, groupTitle, outcomeCode, outcomeTitle, index):
+        self.groupCode = groupCode
+        self.groupTitle = groupTitle
+        self.outcomeCode = outcomeCode
+        self.outcomeTitle = outcomeTitle
+        self.index = index
+    def codeStr(self):
+        return (getOutcomeCode(self.groupCode, self.outcomeCode))
+
+# In the script, outcomes have both a group and outcomes
+# This allows us to sort by groups if desired.
+# For example, group G1 and outcome F1 have the outcome code "G1.F1".
+def getOutcomeCode(group, outcome):
+    return '.'.join([group, outcome])
+
+# Groups are where learning outcomes are organized
+# On Canvas, I have learning outcomes grouped into a hierarchy
+# Each group has a simple code and a descriptor
+# For example "G1: Functions"
+# The script uses the G1 as the group code and Functions as the title.
+# Similarly, an outcome has a code and a title in a similar vein.
+# For example "F1: Defining Functions"
+# The outcome code would be F1 and the title would be Defining Functions
+#
+# The first row of a mastery export has a pair of columns for every outcome
+# after the student name and ID:
+#  "Group_Code: Group_Title > Outcome_Code: Outcome_Title result"
+#  "... mastery points"
+# parseOutcomeHeader returns the outcomes three ways: groups (group code ->
+# { 'title', 'outcomes': list of outcome codes }), a list in column order,
+# and a dictionary by outcome code (see getOutcomeCode).
+def parseOutcomeHeader(headers):
+    groups = dict()
+    outcomeArray = []
+    outcomeDict = dict()
+    numberOutcomes = (len(headers)-2)//2
+    for i in range(numberOutcomes):
+        # Group title separated from Outcome title by '>'
+        parts = headers[2+2*i].split('>')
+
+        # Group and outcome titles use ShortCode: Title
+        groupInfo = [ text.strip() for text in parts[0].split(':') ]
+        groupCode = groupInfo[0]
+        groupTitle = ': '.join(groupInfo[1:])
+
+        outcomeInfo = [ text.strip() for text in parts[1].split(':') ]
+        outcomeCode = outcomeInfo[0]
+        outcomeTitle = ': '.join(outcomeInfo[1:])
+        # Remove the ' result' from end of title
+        outcomeTitle = outcomeTitle[:-7]
+
+        outcome = Outcome(groupCode, groupTitle, outcomeCode, outcomeTitle, i)
+        outcomeDict[outcome.codeStr()] = outcome
+        outcomeArray.append(outcome)
+        group = groups.setdefault(groupCode, { 'title': groupTitle, 'outcomes': [] })
+        group['outcomes'].append(outcomeCode)
+    return groups, outcomeArray, outcomeDict
+
+# Some structure to keep track of who a student is and what they have done.
+# The results are the student's row in a ScoreMatrix (None until the mastery
+# export is read). The forms of the name used for sorting and for file names
+# are worked out once here, since they are used as sort keys.
+class StudentRecord:
+    __slots__ = ('name', 'id', 'row', 'section', 'email', 'first', 'lastFirst', 'lastFirstTight')
+    def __init__(self, student_name, student_id, student_row=None):
+        self.name = student_name
+        self.id = student_id
+        self.row = student_row
+        self.section = ''
+        self.email = ''
+        names = student_name.split(' ')
+        self.first = names[0]
+        self.lastFirst = ','.join([names[-1], ' '.join(names[:-1])])
+        self.lastFirstTight = ''.join([names[-1], ''.join(names[:-1])])
+    @property
+    def hasResults(self):
+        return self.row is not None
+    def setSection(self, section):
+        self.section = section
+    def setEmail(self, address):
+        self.email = address
+    def getEmail(self):
+        return self.email
+    def setResults(self, student_row):
+        self.row = student_row
+    def getFirst(self):
+        return self.first
+    def getLastFirst(self):
+        return self.lastFirst
+    def getLastFirstTight(self):
+        return self.lastFirstTight
+
+# Canvas exports mastery results with a pair of columns for every outcome
+# after the student name and ID columns:
+#  "Outcome_Title result"
+#  "Outcome_Title mastery points"
+# Instead of a dictionary per cell, the scores are kept in one flat float32
+# array with one row per student (students x outcomes, row major), and the
+# points required for mastery in a second array of the same shape.
+# Blank cells count as 0.
+# Only the outcomes that a run actually uses need to be kept: the matrix is
+# built for a list of outcome indices (the position of the outcome in the
+# export header), and only those cells of each row are ever parsed.
+# column[outcomeIndex] gives the matrix column of an outcome.
+class ScoreMatrix:
+    def __init__(self, outcomeIndices):
+        self.outcomeIndices = list(outcomeIndices)
+        self.numOutcomes = len(self.outcomeIndices)
+        self.column = dict([ (outcomeIndex, k) for k, outcomeIndex in enumerate(self.outcomeIndices) ])
+        self.scoreCells = [ 2 + 2*outcomeIndex for outcomeIndex in self.outcomeIndices ]
+        self.requiredCells = [ cell + 1 for cell in self.scoreCells ]
+        self.rowWidth = max(self.requiredCells + [1]) + 1
+        self.numStudents = 0
+        self.scores = array('f')
+        self.required = array('f')
+
+    # Add one row of the mastery export and return its row index.
+    # Short rows are padded with blanks so that every row has the same width.
+    def addRow(self, masteryRow):
+        if len(masteryRow) < self.rowWidth:
+            masteryRow = masteryRow + [''] * (self.rowWidth - len(masteryRow))
+        return self.addValues([ float(masteryRow[k] or 0.0) for k in self.scoreCells ],
+                              [ float(masteryRow[k] or 0.0) for k in self.requiredCells ])
+
+    # Add a row already split into scores and requirements, one per matrix
+    # column, and return its row index.
+    def addValues(self, scores, required):
+        self.scores.extend(scores)
+        self.required.extend(required)
+        self.numStudents = self.numStudents + 1
+        return self.numStudents - 1
+
+    # Add a row with every score and requirement 0, e.g. for a template quiz.
+    def addBlankRow(self):
+        return self.addRow([])
+
+    # Position of the first outcome of a row in the flat arrays.
+    def offset(self, row):
+        return row * self.numOutcomes
+
+    # Mastery for every cell at once, as a bytes object of 0/1 with the same
+    # layout as the scores. Mastery means reaching the required points from
+    # the export or, when a threshold is given, reaching that score instead.
+    def masteryMask(self, threshold=None):
+        if threshold is None:
+            return bytes(map(operator.ge, self.scores, self.required))
+        return bytes([ score >= threshold for score in self.scores ])
+
+    # One byte per cell combining mastery and score level: 0 when not
+    # mastered, otherwise 1 + the score, so that bytes.count() can tally the
+    # levels of whole blocks of cells at once.
+    def levelCodes(self, mask):
+        return bytes([ 1 + min(max(int(score), 0), 254) if mastered else 0
+                       for score, mastered in zip(self.scores, mask) ])
+
+    # One byte per cell saying what a quiz does with the outcome: 0 when it
+    # is mastered (by the mask), otherwise 1 for a problem, or 2 for a problem
+    # marked as at the apprentice level (a score of exactly apprenticeScore).
+    def quizCodes(self, mask, apprenticeScore):
+        notMastered = mask.translate(flipTable)
+        apprentice = map(operator.eq, self.scores, repeat(float(apprenticeScore)))
+        return bytes(map(operator.mul, notMastered, map(operator.add, apprentice, repeat(1))))
+
+    # Number of rows where the mask is set, for one outcome.
+    def countColumn(self, mask, outcomeIndex):
+        return sum(mask[self.column[outcomeIndex]::self.numOutcomes])
+
+# Go through the student rows of a mastery export one at a time, yielding
+# the student name, ID and row in the score matrix. Only the cells of the
+# outcomes in the matrix are parsed, and the CSV rows are not kept, so even
+# very large exports are read with little memory.
+def readMasteryRows(dataStream, scoreMatrix):
+    for masteryRow in dataStream:
+        if len(masteryRow) == 0:
+            continue
+        yield masteryRow[0], masteryRow[1], scoreMatrix.addRow(masteryRow)
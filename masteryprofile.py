@@ -0,0 +1,101 @@
+# Timing of the mastery scripts, turned on with --profile.
+# Every measurement is written as one JSON line to the profile file:
+#  {"script": ..., "event": ..., "seconds": ..., other details}
+# Events are the stages of the script ("stage", with its name and a count
+# of what it handled), and repeated work such as "report" (rendering one
+# student's report), "quiz", "pdflatex" (with the job and exit status) or
+# "mail" (with the address and status). At the end a summary is printed:
+# each stage with its time, and for repeated work the count, p50, p95, max
+# and total time, and how many failed.
+# With --cprofile, the Python side of the main thread is also profiled with
+# cProfile and the statistics are saved for python3 -m pstats.
+# When profiling is off, recording does nothing.
+
+import cProfile
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+def addProfileOptions(parser):
+    parser.add_argument('--profile', default='', help='filepath, write the time of every stage, student, pdflatex run and message as JSON lines and print a summary')
+    parser.add_argument('--cprofile', default='', help='filepath, save cProfile statistics of the run (read with python3 -m pstats)')
+
+# Nearest rank percentile of a sorted list.
+def percentile(sortedTimes, fraction):
+    rank = max(0, min(len(sortedTimes)-1, math.ceil(fraction * len(sortedTimes)) - 1))
+    return sortedTimes[rank]
+
+class Profiler:
+    def __init__(self, script, profilePath='', cprofilePath=''):
+        self.script = script
+        self.enabled = (profilePath != '')
+        self.lock = threading.Lock()
+        self.stages = []
+        self.timings = dict()
+        self.failures = dict()
+        self.profileFile = open(profilePath, 'w') if self.enabled else None
+        self.cprofilePath = cprofilePath
+        self.cprofile = None
+        if cprofilePath != '':
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self.startTime = time.perf_counter()
+        self.lapTime = self.startTime
+
+    # Record one measurement. Safe to call from worker threads.
+    def record(self, event, seconds, **details):
+        if not self.enabled:
+            return
+        entry = { 'script': self.script, 'event': event, 'seconds': round(seconds, 6) }
+        entry.update(details)
+        with self.lock:
+            self.profileFile.write(json.dumps(entry) + '\n')
+            if event == 'stage':
+                self.stages.append(entry)
+            else:
+                self.timings.setdefault(event, []).append(seconds)
+                if details.get('status', 0) not in (0, 'ok'):
+                    self.failures[event] = self.failures.get(event, 0) + 1
+
+    # The scripts run from top to bottom, so a stage ends where the next
+    # one starts: lap records the time since the previous lap.
+    def lap(self, name, count=None):
+        now = time.perf_counter()
+        details = { 'name': name }
+        if count is not None:
+            details['count'] = count
+        self.record('stage', now - self.lapTime, **details)
+        self.lapTime = now
+
+    # Time the body of a with block as one event. The block can add details
+    # (such as an exit status) to the dictionary it is given.
+    @contextmanager
+    def timed(self, event, **details):
+        startTime = time.perf_counter()
+        try:
+            yield details
+        finally:
+            self.record(event, time.perf_counter() - startTime, **details)
+
+    def close(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofilePath)
+            print('cProfile statistics saved in', self.cprofilePath)
+        if not self.enabled:
+            return
+        total = time.perf_counter() - self.startTime
+        self.profileFile.write(json.dumps({ 'script': self.script, 'event': 'total', 'seconds': round(total, 6) }) + '\n')
+        self.profileFile.close()
+        print('Profile of %s: %.3f s in total' % (self.script, total))
+        for entry in self.stages:
+            count = ' (%d)' % entry['count'] if 'count' in entry else ''
+            print('  %-20s %9.3f s%s' % (entry['name'], entry['seconds'], count))
+        for event, times in self.timings.items():
+            times = sorted(times)
+            failed = ', %d failed' % self.failures[event] if event in self.failures else ''
+            print('  %-12s %6d x  p50 %.3f s  p95 %.3f s  max %.3f s  total %.3f s%s'
+                  % (event, len(times), percentile(times, 0.5), percentile(times, 0.95),
+                     times[-1], sum(times), failed))
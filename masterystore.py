@@ -0,0 +1,293 @@
+# A local SQLite store of the Canvas exports, shared by the mastery scripts.
+# mastery-import.py loads a gradebook export and a mastery export into the
+# store as one snapshot per import date. The scripts can then read the
+# latest (or a chosen) snapshot with --store instead of parsing the CSV
+# files again every week.
+#
+# Tables, all keyed by snapshot:
+#  snapshots: import date and the header row of the mastery export
+#  roster: the gradebook, one row per student in file order
+#   (name, Canvas ID, SIS login used for email, section)
+#  masteryRows: the students of the mastery export in file order
+#  scores: one row per (student, outcome) cell with points earned and
+#   points required for mastery. Blank cells count as 0, and cells with
+#   nothing earned or required are not stored.
+# Students are indexed on Canvas ID, login and normalized name, and scores
+# on outcome, so a run only reads the outcomes it actually uses.
+#
+# Consecutive snapshots can be compared (changedOutcomes) to find the
+# students whose mastery changed since the previous import, so that the
+# reports can skip everyone else with --changedOnly. (mastery-quizzes.py
+# has no need: its manifest already skips every quiz that did not change,
+# and also notices a new week or template.)
+
+import csv
+import json
+import sqlite3
+import time
+
+schema = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    snapshot INTEGER PRIMARY KEY,
+    importDate TEXT UNIQUE NOT NULL,
+    masteryHeader TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS roster (
+    snapshot INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    nameKey TEXT NOT NULL,
+    id TEXT NOT NULL,
+    login TEXT NOT NULL,
+    section TEXT NOT NULL,
+    PRIMARY KEY (snapshot, position)
+);
+CREATE INDEX IF NOT EXISTS rosterByID ON roster (snapshot, id);
+CREATE INDEX IF NOT EXISTS rosterByLogin ON roster (snapshot, login);
+CREATE INDEX IF NOT EXISTS rosterByName ON roster (snapshot, nameKey);
+CREATE TABLE IF NOT EXISTS masteryRows (
+    snapshot INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    nameKey TEXT NOT NULL,
+    id TEXT NOT NULL,
+    PRIMARY KEY (snapshot, position)
+);
+CREATE INDEX IF NOT EXISTS masteryRowsByID ON masteryRows (snapshot, id);
+CREATE TABLE IF NOT EXISTS scores (
+    snapshot INTEGER NOT NULL,
+    outcomeIndex INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    score REAL NOT NULL,
+    required REAL NOT NULL,
+    PRIMARY KEY (snapshot, outcomeIndex, position)
+) WITHOUT ROWID;
+"""
+
+# Names are matched ignoring case and extra spaces.
+def normalizeName(name):
+    return ' '.join(name.lower().split())
+
+# Command line options shared by the scripts that can read from the store.
+def addStoreOptions(parser, changedOnly=False):
+    parser.add_argument('--store', default='', help='file path, SQLite store created by mastery-import.py, used instead of the CSV exports')
+    parser.add_argument('--snapshot', default='', help='date (YYYY-MM-DD), snapshot of the store to use (default: the latest)')
+    if changedOnly:
+        parser.add_argument('--changedOnly', '--changed-only', dest='changedOnly', action='store_true', help='flag, with --store, only include students whose mastery of the included outcomes changed since the previous snapshot')
+
+class MasteryStore:
+    def __init__(self, storePath, importDate=''):
+        self.db = sqlite3.connect(storePath)
+        self.db.executescript(schema)
+        self.snapshot = None
+        if importDate != '':
+            found = self.db.execute('SELECT snapshot FROM snapshots WHERE importDate = ?', (importDate,)).fetchone()
+            if found is None:
+                raise SystemExit('No snapshot from %s in %s' % (importDate, storePath))
+            self.snapshot = found[0]
+        else:
+            found = self.db.execute('SELECT snapshot FROM snapshots ORDER BY importDate DESC LIMIT 1').fetchone()
+            if found is not None:
+                self.snapshot = found[0]
+
+    def close(self):
+        self.db.close()
+
+    # Load a gradebook export and a mastery export as the snapshot for
+    # importDate (today by default), replacing any earlier import that day.
+    # In the gradebook, column 1 is the name, column 2 the Canvas ID,
+    # column 4 the login and column 5 the section. Its "Points Possible"
+    # row is not a student and is left out.
+    # Either file can be None when it has not changed: that half of the
+    # latest other snapshot is then copied over instead of parsed again.
+    def importExports(self, gradesFile, masteryFile, importDate=''):
+        if importDate == '':
+            importDate = time.strftime('%Y-%m-%d')
+        with self.db:
+            source = self.db.execute('SELECT snapshot, masteryHeader FROM snapshots WHERE importDate != ? ORDER BY importDate DESC LIMIT 1',
+                                     (importDate,)).fetchone()
+            if (gradesFile is None or masteryFile is None) and source is None:
+                raise SystemExit('There is no earlier snapshot to take the unchanged export from.')
+            found = self.db.execute('SELECT snapshot FROM snapshots WHERE importDate = ?', (importDate,)).fetchone()
+            if found is not None:
+                for table in ['scores', 'masteryRows', 'roster', 'snapshots']:
+                    self.db.execute('DELETE FROM %s WHERE snapshot = ?' % table, found)
+
+            if masteryFile is None:
+                snapshot = self.db.execute('INSERT INTO snapshots (importDate, masteryHeader) VALUES (?, ?)',
+                                           (importDate, source[1])).lastrowid
+                self.db.execute('INSERT INTO masteryRows SELECT ?, position, name, nameKey, id FROM masteryRows WHERE snapshot = ?',
+                                (snapshot, source[0]))
+                self.db.execute('INSERT INTO scores SELECT ?, outcomeIndex, position, score, required FROM scores WHERE snapshot = ?',
+                                (snapshot, source[0]))
+                numMastery = self.db.execute('SELECT COUNT(*) FROM masteryRows WHERE snapshot = ?', (snapshot,)).fetchone()[0]
+            else:
+                snapshot, numMastery = self.importMastery(masteryFile, importDate)
+
+            if gradesFile is None:
+                self.db.execute('INSERT INTO roster SELECT ?, position, name, nameKey, id, login, section FROM roster WHERE snapshot = ?',
+                                (snapshot, source[0]))
+                numRoster = self.db.execute('SELECT COUNT(*) FROM roster WHERE snapshot = ?', (snapshot,)).fetchone()[0]
+            else:
+                numRoster = self.importRoster(gradesFile, snapshot)
+        self.snapshot = snapshot
+        return importDate, numRoster, numMastery
+
+    # Parse a mastery export into a new snapshot. Returns (snapshot, number of rows).
+    def importMastery(self, masteryFile, importDate):
+        with open(masteryFile, newline='') as masteryStream:
+            dataStream = csv.reader(masteryStream)
+            headers = next(dataStream)
+            snapshot = self.db.execute('INSERT INTO snapshots (importDate, masteryHeader) VALUES (?, ?)',
+                                       (importDate, json.dumps(headers))).lastrowid
+            numberOutcomes = (len(headers)-2)//2
+            position = 0
+            for masteryRow in dataStream:
+                if len(masteryRow) == 0:
+                    continue
+                self.db.execute('INSERT INTO masteryRows VALUES (?, ?, ?, ?, ?)',
+                                (snapshot, position, masteryRow[0], normalizeName(masteryRow[0]), masteryRow[1]))
+                cells = []
+                for i in range(numberOutcomes):
+                    col = 2+2*i
+                    score = float((masteryRow[col] if col < len(masteryRow) else '') or 0.0)
+                    required = float((masteryRow[col+1] if col+1 < len(masteryRow) else '') or 0.0)
+                    if score != 0.0 or required != 0.0:
+                        cells.append((snapshot, i, position, score, required))
+                self.db.executemany('INSERT INTO scores VALUES (?, ?, ?, ?, ?)', cells)
+                position = position + 1
+            return snapshot, position
+
+    # Parse a gradebook export into the roster of a snapshot. Returns the number of students.
+    def importRoster(self, gradesFile, snapshot):
+        with open(gradesFile, newline='') as gradesStream:
+            dataStream = csv.reader(gradesStream)
+            headers = next(dataStream)
+            position = 0
+            for student in dataStream:
+                if len(student) < 5 or student[0].strip() == 'Points Possible':
+                    continue
+                self.db.execute('INSERT INTO roster VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (snapshot, position, student[0], normalizeName(student[0]),
+                                 student[1], student[3], student[4]))
+                position = position + 1
+            return position
+
+    def importDates(self):
+        return [ row[0] for row in self.db.execute('SELECT importDate FROM snapshots ORDER BY importDate') ]
+
+    def requireSnapshot(self):
+        if self.snapshot is None:
+            raise SystemExit('The store is empty, use mastery-import.py to load the exports first.')
+        return self.snapshot
+
+    # The gradebook students as (name, id, login, section), in file order.
+    def readRoster(self):
+        return self.db.execute('SELECT name, id, login, section FROM roster WHERE snapshot = ? ORDER BY position',
+                               (self.requireSnapshot(),)).fetchall()
+
+    # The header row of the mastery export, as parseHeader expects it.
+    def readMasteryHeader(self):
+        found = self.db.execute('SELECT masteryHeader FROM snapshots WHERE snapshot = ?',
+                                (self.requireSnapshot(),)).fetchone()
+        return json.loads(found[0])
+
+    # Sections of the students in the mastery export, by their name there.
+    # The two exports are joined on the Canvas ID, falling back to the
+    # normalized name for students whose ID does not match.
+    def readMasterySections(self):
+        rows = self.db.execute("""
+            SELECT m.name, COALESCE(
+                (SELECT section FROM roster r WHERE r.snapshot = m.snapshot AND r.id = m.id),
+                (SELECT section FROM roster r WHERE r.snapshot = m.snapshot AND r.nameKey = m.nameKey))
+            FROM masteryRows m WHERE m.snapshot = ? ORDER BY m.position""",
+            (self.requireSnapshot(),))
+        return dict([ (name, section) for name, section in rows if section is not None ])
+
+    # Same as masterycore.readMasteryRows, but only the cells of the outcomes
+    # in the matrix are read from the store.
+    def readMasteryRows(self, scoreMatrix):
+        snapshot = self.requireSnapshot()
+        cells = dict()
+        if scoreMatrix.numOutcomes > 0:
+            query = 'SELECT position, outcomeIndex, score, required FROM scores WHERE snapshot = ? AND outcomeIndex IN (%s)' \
+                    % ','.join(['?'] * scoreMatrix.numOutcomes)
+            for position, outcomeIndex, score, required in self.db.execute(query, [snapshot] + scoreMatrix.outcomeIndices):
+                cells.setdefault(position, []).append((scoreMatrix.column[outcomeIndex], score, required))
+        for position, name, id in self.db.execute('SELECT position, name, id FROM masteryRows WHERE snapshot = ? ORDER BY position', (snapshot,)):
+            scores = [0.0] * scoreMatrix.numOutcomes
+            required = [0.0] * scoreMatrix.numOutcomes
+            for column, score, requiredPoints in cells.get(position, []):
+                scores[column] = score
+                required[column] = requiredPoints
+            yield name, id, scoreMatrix.addValues(scores, required)
+
+    def importDate(self):
+        found = self.db.execute('SELECT importDate FROM snapshots WHERE snapshot = ?',
+                                (self.requireSnapshot(),)).fetchone()
+        return found[0]
+
+    # The snapshot imported just before this one, or None for the first.
+    def previousSnapshot(self):
+        found = self.db.execute('SELECT snapshot FROM snapshots WHERE importDate < ? ORDER BY importDate DESC LIMIT 1',
+                                (self.importDate(),)).fetchone()
+        return None if found is None else found[0]
+
+    # Put the cells of a snapshot in a temporary table, with each outcome
+    # identified by its title since Canvas may order the columns differently
+    # in every export.
+    def loadCells(self, snapshot, table):
+        outcomeTitles = self.db.execute('SELECT masteryHeader FROM snapshots WHERE snapshot = ?', (snapshot,)).fetchone()
+        headers = json.loads(outcomeTitles[0])
+        self.db.execute('DROP TABLE IF EXISTS temp.%sTitles' % table)
+        self.db.execute('CREATE TEMP TABLE %sTitles (outcomeIndex INTEGER PRIMARY KEY, title TEXT)' % table)
+        self.db.executemany('INSERT INTO temp.%sTitles VALUES (?, ?)' % table,
+                            [ (i, headers[2+2*i]) for i in range((len(headers)-2)//2) ])
+        self.db.execute('DROP TABLE IF EXISTS temp.%s' % table)
+        self.db.execute("""
+            CREATE TEMP TABLE %s AS
+            SELECT m.id AS id, t.title AS title, s.outcomeIndex AS outcomeIndex, s.score AS score, s.required AS required
+            FROM scores s
+            JOIN masteryRows m ON m.snapshot = s.snapshot AND m.position = s.position
+            JOIN temp.%sTitles t ON t.outcomeIndex = s.outcomeIndex
+            WHERE s.snapshot = ?""" % (table, table), (snapshot,))
+        self.db.execute('CREATE INDEX temp.%sByCell ON %s (id, title)' % (table, table))
+
+    # Compare this snapshot with the previous one, cell by cell.
+    # Returns a dictionary from Canvas ID to the set of outcome indices (in
+    # this snapshot) whose score or requirement changed, with None for
+    # students who were not in the previous export at all. Students without
+    # changes are not in the dictionary. Without a previous snapshot, the
+    # result is None: everything is new.
+    def changedOutcomes(self):
+        previous = self.previousSnapshot()
+        if previous is None:
+            return None
+        self.loadCells(self.snapshot, 'currentCells')
+        self.loadCells(previous, 'previousCells')
+        changes = dict()
+        for id, outcomeIndex in self.db.execute("""
+            SELECT c.id, c.outcomeIndex FROM temp.currentCells c
+            LEFT JOIN temp.previousCells p ON p.id = c.id AND p.title = c.title
+            WHERE p.id IS NULL OR p.score <> c.score OR p.required <> c.required
+            UNION
+            SELECT p.id, t.outcomeIndex FROM temp.previousCells p
+            JOIN temp.currentCellsTitles t ON t.title = p.title
+            LEFT JOIN temp.currentCells c ON c.id = p.id AND c.title = p.title
+            WHERE c.id IS NULL"""):
+            changes.setdefault(id, set()).add(outcomeIndex)
+        for (id,) in self.db.execute("""
+            SELECT m.id FROM masteryRows m WHERE m.snapshot = ?
+            AND NOT EXISTS (SELECT 1 FROM masteryRows p WHERE p.snapshot = ? AND p.id = m.id)""",
+            (self.snapshot, previous)):
+            changes[id] = None
+        return changes
+
+# The Canvas IDs of the students with a change in any of the given outcome
+# indices, or None if there is nothing to compare with.
+def changedStudents(changes, outcomeIndices):
+    if changes is None:
+        return None
+    outcomeIndices = set(outcomeIndices)
+    return set([ id for id, outcomes in changes.items()
+                 if outcomes is None or len(outcomes & outcomeIndices) > 0 ])
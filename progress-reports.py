@@ -1,8 +1,17 @@
 import csv
 import argparse
-import subprocess
+import io
+import math
+import multiprocessing
 import os
 import re
+import json
+import string
+from concurrent.futures import ProcessPoolExecutor
+from masterycore import ScoreMatrix, StudentRecord, getOutcomeCode, parseOutcomeHeader, readMasteryRows
+from maildelivery import addMailOptions, createBackend
+from masterystore import addStoreOptions, MasteryStore, changedStudents
+from masteryprofile import addProfileOptions, Profiler
 
 # The script is based on using a Canvas Learning Mastery report export to generate
 # a summary for each student that will be emailed.
@@ -17,345 +26,364 @@ masteryStatus = { 0:'Not Yet', 1:"Satisfied", 2:"Apprentice", 3:"Journey", 4:"Ma
 # The script will show the status for each outcome and provide a summary count
 # at the end showing totals.
 
-# This script is Mac-specific using Apple Mail, so that messages
-# are created as a draft. In text files, I generate a preamble and postamble
-# and the automated summary is generated in the middle.
-def asrun(ascript):
-    "Run the given AppleScript and return the standard output and error."
-
-    osa = subprocess.Popen(['osascript', '-'],
-                           stdin=subprocess.PIPE,
-                           stdout=subprocess.PIPE)
-    return osa.communicate(ascript)[0]
-
-def asquote(astr):
-    "Return the AppleScript equivalent of the given string."
-
-    astr = astr.replace('"', '" & quote & "')
-    return '"{}"'.format(astr)
-
+# Originally this script was Mac-specific using Apple Mail, so that messages
+# are created as a draft. That is still the default, but messages can also be
+# sent over SMTP (see maildelivery.py). In text files, I generate a preamble
+# and postamble and the automated summary is generated in the middle.
 
 parser = argparse.ArgumentParser(description='Import a Canvas gradebook (for student records) and mastery export file (for progress) and produce a summary that is emailed.')
 parser.add_argument('--studentData', help='file path, CSV of Canvas grade export to get section information')
 parser.add_argument('--masteryData', help='file path, CSV of Canvas learning mastery report')
 parser.add_argument('--outcomeFile', help='file path, text file with 4 columns: group code (text), outcome code (text), latex command stem (only alpha), week introduced')
-parser.add_argument('--msgA', default='', help='filepath, text message with preamble')
-parser.add_argument('--msgB', default='', help='filepath, text message with postamble')
-parser.add_argument('--tempFile', default='tmpmsg.txt', help='filepath, location where message is saved before pushing the draft to Mail')
+parser.add_argument('--msgA', default='', help='filepath, text message with preamble (may use $first, $name, $section, $mastered, $points)')
+parser.add_argument('--msgB', default='', help='filepath, text message with postamble (same placeholders as msgA)')
+parser.add_argument('--tempFile', default='', help='filepath, location where message is saved before pushing the draft to Mail (--mailer applemail, default a private temporary file)')
 parser.add_argument('--summary', dest='summaryReport', default='', help='filepath, instead of sending emails, create a single summary file of all reports')
+parser.add_argument('--format', dest='summaryFormat', default='txt', choices=['txt', 'csv', 'json'], help='text, --summary as the text reports (txt) or as one record of numbers per student (csv, json)')
+parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='integer, number of processes rendering the text --summary (default: one per CPU)')
+parser.add_argument('--stats', default='', help='filepath, instead of sending emails, write class-wide pass rates by outcome, group, section and week (.json for JSON, otherwise CSV)')
 parser.add_argument('--skipStudents', type=int, default=0, help='integer, number of students to skip for debugging')
 parser.add_argument('--student', default='', help='text, match students to text and only create report for them')
 parser.add_argument('--subject', default='Your Mastery Progress', help='text, emailer subject line')
+addMailOptions(parser)
+addStoreOptions(parser, changedOnly=True)
+addProfileOptions(parser)
 args = parser.parse_args()
-
-# Some structure to keep track of outcomes, organized by groups.
-class Outcome:
-    def __init__(self, groupCode, groupTitle, outcomeCode, outcomeTitle, index):
-        self.groupCode = groupCode
-        self.groupTitle = groupTitle
-        self.outcomeCode = outcomeCode
-        self.outcomeTitle = outcomeTitle
-        self.index = index
-    def codeStr(self):
-        return (getOutcomeCode(self.groupCode, self.outcomeCode))
-
-# Some structure to keep track of who a student is and what they have done.
-class StudentRecord:
-    def __init__(self, student_name, student_id):
-        self.name = student_name
-        self.id = student_id
-        self.hasResults = False
-    def setEmail(self, emailName):
-        self.email = emailName + studentEmailDomain
-    def getEmail(self):
-        return self.email
-    def setResults(self,student_results):
-        self.results = student_results
-        self.hasResults = True
-    def getFirst(self):
-        firstName = self.name.split(' ')[0]
-        return firstName
-    def getLastFirst(self):
-        names = self.name.split(' ')
-        return ','.join([names[-1], ' '.join(names[:-1])])
-    def getLastFirstTight(self):
-        names = self.name.split(' ')
-        return ''.join([names[-1], ''.join(names[:-1])])
-
-# Groups are where learning outcomes are organized
-# On Canvas, I have learning outcomes grouped into a hierarchy
-# Each group has a simple code and a descriptor
-# For example "G1: Functions"
-# The script uses the G1 as the group code and Functions as the title.
-# Similarly, an outcome has a code and a title in a similar vein.
-# For example "F1: Defining Functions"
-# The outcome code would be F1 and the title would be Defining Functions
-groups = dict()
-outcomeArray = []
-outcomeDict = dict()
-def addOutcome(outcome):
-    code = outcome.codeStr()
-    outcomeDict[code] = outcome
-    outcomeArray.append(outcome)
-    group = groups.get(outcome.groupCode, { 'title':outcome.groupTitle, 'outcomes': [] })
-    group['outcomes'].append(outcome.outcomeCode)
-    groups[outcome.groupCode] = group
-
-# In the script, outcomes have both a group and outcomes
-# This allows us to sort by groups if desired.
-# Using the example above, this function would return "G1.F1" as the outcome code.
-def getOutcomeCode(group, outcome):
-    return '.'.join([group, outcome])
-
-# Parse the first row of the data table
-# Extracts the information for outcome descriptions
-# My Outcome Titles include the Outcome and Title, so we pull this off for tracking.
-def parseMasteryHeader(headers):
-    # Canvas exports outcome information in the headers.
-    # Column 1: Student Name
-    # Column 2: Student # ID
-    # Pairs of columns:
-    #  "Outcome_Title result"
-    #  "Outcome_Title mastery points"
-    numberOutcomes = (len(headers)-2)//2
-    for i in range(numberOutcomes):
-        col = 2+2*i
-        outcome = headers[col]
-        # Group title separated from Outcome title by '>'
-        parts = outcome.split('>')
-
-        # Group and outcome titles use ShortCode: Title
-        groupInfo = [ text.strip() for text in parts[0].split(':') ]
-        groupCode = groupInfo[0]
-        groupTitle = ': '.join(groupInfo[1:])
-
-        outcomeInfo = [ text.strip() for text in parts[1].split(':') ]
-        outcomeCode = outcomeInfo[0]
-        outcomeTitle = ': '.join(outcomeInfo[1:])
-        # Remove the ' result' from end of title
-        outcomeTitle = outcomeTitle[:-7]
-
-        # Generate the outcome record
-        outcome = Outcome(groupCode, groupTitle, outcomeCode, outcomeTitle, i)
-        addOutcome(outcome)
-
-# Parse one row of the table corresponding to a student's mastery record
-# The ordering of columns is described above in parseHeader
-def parseMasteryRow(studentMasteryRow):
-    # Column 1: name
-    name = studentMasteryRow[0]
-    # Column 2: student_id
-    id = studentMasteryRow[1]
-
+if args.changedOnly and args.store == '':
+    parser.error('--changedOnly compares snapshots, so it needs --store')
+profiler = Profiler('progress-reports', args.profile, args.cprofile)
+
+# Attach one row of the table corresponding to a student's mastery record
+# The ordering of columns is described in parseOutcomeHeader
+# Column 1 is the name and column 2 the student_id, while the remaining
+# columns in pairs (points earned, required for mastery) were already read
+# into the given row of the score matrix by readMasteryRows.
+def parseMasteryRow(name, id, row):
     # Recall the student's record.
-    studentRecord = studentsByID.get(id, StudentRecord(name, id))
-
-    # Remaining columns in pairs corresponding to mastery data
-    # - points earned
-    # - required for mastery
-    numOutcomes = (len(studentMasteryRow)-2)//2
-    results = []
-    for i in range(numOutcomes):
-        k = 2+2*i
-        mastered = False
-        if len(studentMasteryRow[k])==0:
-            score = 0.0
-        else:
-            score = float(studentMasteryRow[k])
-        if len(studentMasteryRow[k+1])==0:
-            required = 0.0
-        else:
-            required = float(studentMasteryRow[k+1])
-        results.append({ 'score': score, 'mastery': (score >= required) })
-    studentRecord.setResults(results)
+    studentRecord = studentsByID.get(id)
+    if studentRecord is None:
+        studentRecord = StudentRecord(name, id)
+    studentRecord.setResults(row)
     return studentRecord
 
+# The layout of the report is the same for every student, so it is worked
+# out once per run. Outcomes are grouped together by Group code and sorted
+# by outcome codes (number first, then any suffix such as the a in E1a).
+# The plan is a list with one entry per group, in order:
+#   (group header line, [ (column, partial column, line start, code), ... ])
+# where the columns are positions in the score matrix, the partial
+# column is None for outcomes without partial progress, and code is the
+# outcome code (see getOutcomeCode).
+outcomeCodePattern = re.compile(r'\A([A-Za-z]*)([0-9]*)(.*)')
+def outcomeSortKey(outcomeCode):
+    matches = outcomeCodePattern.match(outcomeCode)
+    return (int(matches.group(2)), matches.group(3))
+
+def buildReportPlan():
+    plan = []
+    for groupCode in sorted(groups.keys()):
+        group = groups[groupCode]
+        header = ''.join([groupCode, ': ', group['title'], '\n'])
+        entries = []
+        for outcomeCode in sorted(group['outcomes'], key=outcomeSortKey):
+            code = getOutcomeCode(groupCode, outcomeCode)
+            # See if this outcome is to be included
+            if code in useOutcomeDict:
+                outcome = outcomeDict[code]
+                partialColumn = None
+                if code in partialOutcomeDict:
+                    partial = outcomeDict[partialOutcomeDict[code]]
+                    partialColumn = scoreMatrix.column[partial.index]
+                lineStart = ''.join(['  ', outcomeCode, ' ', outcome.outcomeTitle, ': '])
+                entries.append((scoreMatrix.column[outcome.index], partialColumn, lineStart, code))
+        plan.append((header, entries))
+    return plan
+
 # Generate the portion of the email that comes from the summary of outcomes.
 # This follows the preamble file and will be followed by a postamble.
-# Outcomes are grouped together by Group code and sorted by outcome codes.
+# The outcomes are listed following reportPlan.
 # A final summary is at the end.
+# Returns the number of mastered outcomes and the total mastery points.
 def generateReport(reportFile, studentRecord):
     numMastered = 0
     masteryPoints = 0
     masteryCount = { 1:0, 2:0, 3:0, 4:0 }
 
-    # Each new group, we want to include a header line to the report
-    def addGroupHeader(groupCode):
-        # Display group header information
-        group = groups[groupCode]
-        reportFile.write(''.join([groupCode, ': ', group['title']]))
-        reportFile.write('\n')
+    # Where this student's scores start in the score matrix.
+    base = scoreMatrix.offset(studentRecord.row)
 
-    # Pull out the group/outcome code information for sorting.
-    def outcomeGroup(outcomeCode):
-        matches = re.search('\A([A-Za-z]*)', outcomeCode)
-        return(matches.group(0))
-    def outcomeCount(outcomeCode):
-        matches = re.search('\A([A-Za-z]*)([0-9]*)', outcomeCode)
-        return(int(matches.group(2)))
-    def outcomeSuffix(outcomeCode):
-        matches = re.search('\A([A-Za-z]*)([0-9]*)(.*)', outcomeCode)
-        return(matches.group(3))
-
-    groupCodes = sorted(groups.keys())
-    for groupCode in groupCodes:
+    for header, entries in reportPlan:
         # Display group header information when outcome appears.
-        needGroupHeader = True
-        group = groups[groupCode]
-        numInGroup = 0
-        totInGroup = 0
-
-        # Go through the outcomes from this group.
-        outcomeCodes = sorted(group['outcomes'], key=outcomeSuffix)
-        outcomeCodes = sorted(outcomeCodes, key=outcomeCount)
-        for outcomeCode in outcomeCodes:
-            code = getOutcomeCode(groupCode, outcomeCode)
-            # See if this outcome is to be included
-            if code in useOutcomeDict:
-                # Is this the first included outcome for the group?
-                if needGroupHeader:
-                    addGroupHeader(groupCode)
-                    needGroupHeader = False
-
-                # Now generate the output for this outcome.
-                # Also update the overall statistics for the outcome
-                totInGroup = totInGroup + 1
-                outcome = outcomeDict[code]
-                outcomeStat = outcomeStats[code]
-                progress = ''
-                # See if this is a partial progress problem.
-                hasPartial = False
-                if code in partialOutcomeDict:
-                    hasPartial = True
-                    partial = outcomeDict[partialOutcomeDict[code]]
-                    partialProgress = studentRecord.results[partial.index]['mastery']
-                if studentRecord.results[outcome.index]['mastery']:
-                    score = int(studentRecord.results[outcome.index]['score'])
-                    progress = masteryStatus[score]
-                    masteryCount[score] = masteryCount[score] + 1
-                    numMastered = numMastered + 1
-                    masteryPoints = masteryPoints + score
-                    numInGroup = numInGroup + 1
-                    outcomeStat[0] = outcomeStat[0] + 1
+        if len(entries) > 0:
+            reportFile.write(header)
+
+        # Now generate the output for each outcome.
+        for column, partialColumn, lineStart, code in entries:
+            progress = ''
+            cell = base + column
+            if masteredMask[cell]:
+                score = int(scoreMatrix.scores[cell])
+                progress = masteryStatus[score]
+                masteryCount[score] = masteryCount[score] + 1
+                numMastered = numMastered + 1
+                masteryPoints = masteryPoints + score
+            elif partialColumn is not None:
+                # This is a partial progress problem.
+                if masteredMask[base + partialColumn]:
+                    progress = '1/2'
                 else:
-                    outcomeStat[1] = outcomeStat[1] + 1
-                    if hasPartial:
-                        if partialProgress:
-                            progress = '1/2'
-                        else:
-                            progress = '0/2'
-                outcomeStats[code] = outcomeStat
-                reportFile.write(''.join(['  ', outcomeCode, ' ', outcome.outcomeTitle,': ', progress]))
-                reportFile.write('\n')
-        #if totInGroup > 0:
-        #    reportFile.write('Mastered Objectives in Group: %d out of %d\n' % (numInGroup, totInGroup))
+                    progress = '0/2'
+            reportFile.write(lineStart + progress + '\n')
         reportFile.write('\n')
     reportFile.write('\nOverall Summary:\n')
     for score in [1, 2, 3, 4]:
         if masteryCount[score] > 0:
             reportFile.write('  Number of "%s" outcomes (%d pt each): %d\n' % (masteryStatus[score], score, masteryCount[score]))
     reportFile.write('Total Number of Mastery Points: ' + str(masteryPoints) + '\n')
+    return numMastered, masteryPoints
 
+# The text summary is every student's report one after the other.
+def summaryText(studentRecord):
+    if not studentRecord.hasResults:
+        return studentRecord.name + " (No Results)\n\n"
+    reportStream = io.StringIO()
+    reportStream.write(studentRecord.name + '\n')
+    generateReport(reportStream, studentRecord)
+    reportStream.write('\n\n\n')
+    return reportStream.getvalue()
+
+def summaryChunk(chunk):
+    return ''.join([ summaryText(studentData[i]) for i in chunk ])
+
+# For a large class, the reports are rendered by args.jobs processes in
+# chunks of students. The processes are forked, so they start with
+# everything already read, and the chunks come back (and are written) in
+# the order of the students. The per-student timings are only kept when
+# the reports are rendered here, one at a time.
+summaryChunkSize = 250
 def prepareSummary(order):
+    if args.summaryFormat != 'txt':
+        prepareSummaryRecords(order)
+        return
     with open(args.summaryReport, 'w') as reportStream:
-        for i in order:
-            studentRecord = studentData[i]
-            if (args.student == '' or studentRecord.name.lower().find(args.student.lower()) >= 0):
-                if not studentRecord.hasResults:
-                    reportStream.write(studentRecord.name + " (No Results)\n\n")
-                    continue
-                reportStream.write(studentRecord.name + '\n')
-                generateReport(reportStream, studentRecord)
-                reportStream.write('\n\n\n')
+        if args.jobs <= 1 or len(order) <= summaryChunkSize or 'fork' not in multiprocessing.get_all_start_methods():
+            for i in order:
+                with profiler.timed('report', student=studentData[i].id):
+                    reportStream.write(summaryText(studentData[i]))
+            return
+        chunkSize = max(summaryChunkSize, math.ceil(len(order) / (4 * args.jobs)))
+        chunks = [ order[k:k+chunkSize] for k in range(0, len(order), chunkSize) ]
+        with ProcessPoolExecutor(max_workers=args.jobs, mp_context=multiprocessing.get_context('fork')) as pool:
+            for text in pool.map(summaryChunk, chunks):
+                reportStream.write(text)
+
+# With --format csv or json, the summary has one record per student with
+# numbers taken straight from the score matrix: for each included outcome
+# (in the order of the reports, named by outcome code) the mastery level
+# reached, or 0 for not yet, and for outcomes with partial progress whether
+# the partial outcome is done (1) or not (0). Also the number of mastered
+# outcomes and the total mastery points, as in the text report.
+def prepareSummaryRecords(order):
+    levels = scoreMatrix.levelCodes(masteredMask)
+    entries = [ entry for header, groupEntries in reportPlan for entry in groupEntries ]
+    partialEntries = [ entry for entry in entries if entry[1] is not None ]
+    records = []
+    for i in order:
+        studentRecord = studentData[i]
+        record = { 'name': studentRecord.name, 'id': studentRecord.id, 'section': studentRecord.section,
+                   'mastered': None, 'points': None, 'outcomes': None, 'partial': None }
+        if studentRecord.hasResults:
+            base = scoreMatrix.offset(studentRecord.row)
+            outcomeLevels = [ max(levels[base + column] - 1, 0) for column, partialColumn, lineStart, code in entries ]
+            record['mastered'] = len(outcomeLevels) - outcomeLevels.count(0)
+            record['points'] = sum(outcomeLevels)
+            record['outcomes'] = dict(zip([ entry[3] for entry in entries ], outcomeLevels))
+            record['partial'] = dict([ (code, masteredMask[base + partialColumn])
+                                       for column, partialColumn, lineStart, code in partialEntries ])
+        records.append(record)
+
+    with open(args.summaryReport, 'w', newline='') as summaryFile:
+        if args.summaryFormat == 'json':
+            json.dump(records, summaryFile, indent=1)
+            return
+        writer = csv.writer(summaryFile)
+        writer.writerow(['name', 'id', 'section', 'mastered', 'points'] + [ entry[3] for entry in entries ]
+                        + [ entry[3] + ' partial' for entry in partialEntries ])
+        for record in records:
+            row = [record['name'], record['id'], record['section'], record['mastered'], record['points']]
+            if record['outcomes'] is not None:
+                row = row + list(record['outcomes'].values()) + list(record['partial'].values())
+            writer.writerow(row)
+
+# Class-wide statistics over the included outcomes, without writing any
+# reports. Each cell of the score matrix gets a level code (see levelCodes),
+# and every statistic is a tally of the codes in some block of cells:
+# a column for an outcome, the sum of outcomes for a group or for the week
+# (column 4 of the outcome file) they were introduced, and the rows of a
+# section (column 5 of the gradebook export) for a section.
+# Each statistic reports the number of cells, how many passed and how many
+# were at each mastery level.
+def statsRow(scope, key, title, counts):
+    cells = sum(counts)
+    passed = cells - counts[0]
+    row = { 'scope': scope, 'key': key, 'title': title, 'cells': cells,
+            'passed': passed, 'notYet': counts[0],
+            'passRate': round(passed / cells, 4) if cells > 0 else 0.0 }
+    for score in [1, 2, 3, 4]:
+        row[masteryStatus[score]] = counts[score+1]
+    return row
+
+def levelCounts(levels):
+    return [ levels.count(code) for code in range(6) ]
+
+def addCounts(total, counts):
+    return [ a + b for a, b in zip(total, counts) ]
+
+def prepareStats():
+    levels = scoreMatrix.levelCodes(masteredMask)
+    n = scoreMatrix.numOutcomes
+
+    # Only students from the gradebook with results are counted.
+    rowsBySection = dict()
+    for studentRecord in studentData:
+        if studentRecord.hasResults:
+            rowsBySection.setdefault(studentRecord.section, []).append(studentRecord.row)
+    rows = sorted([ row for sectionRows in rowsBySection.values() for row in sectionRows ])
+    def levelsOfRows(rowList):
+        return b''.join([ levels[row*n:(row+1)*n] for row in rowList ])
+    classLevels = levelsOfRows(rows)
+
+    columns = []
+    outcomeRows = []
+    groupCounts = dict()
+    weekCounts = dict()
+    total = [0] * 6
+    for outcomeRow in useOutcomes:
+        code = getOutcomeCode(outcomeRow[0], outcomeRow[1])
+        if code not in outcomeDict:
+            continue
+        outcome = outcomeDict[code]
+        column = scoreMatrix.column[outcome.index]
+        columns.append(column)
+        counts = levelCounts(classLevels[column::n])
+        outcomeRows.append(statsRow('outcome', code, outcome.outcomeTitle, counts))
+        groupCounts[outcome.groupCode] = addCounts(groupCounts.get(outcome.groupCode, [0] * 6), counts)
+        week = outcomeRow[3] if len(outcomeRow) > 3 else ''
+        weekCounts[week] = addCounts(weekCounts.get(week, [0] * 6), counts)
+        total = addCounts(total, counts)
+
+    results = outcomeRows
+    for groupCode in sorted(groupCounts):
+        results.append(statsRow('group', groupCode, groups[groupCode]['title'], groupCounts[groupCode]))
+    for section in sorted(rowsBySection):
+        sectionLevels = levelsOfRows(rowsBySection[section])
+        counts = [0] * 6
+        for column in columns:
+            counts = addCounts(counts, levelCounts(sectionLevels[column::n]))
+        results.append(statsRow('section', section, '%d students' % len(rowsBySection[section]), counts))
+    def weekKey(week):
+        return (0, int(week), '') if week.isdigit() else (1, 0, week)
+    for week in sorted(weekCounts, key=weekKey):
+        results.append(statsRow('week', week, '', weekCounts[week]))
+    results.append(statsRow('all', '', '%d students' % len(rows), total))
+
+    with open(args.stats, 'w', newline='') as statsFile:
+        if args.stats.lower().endswith('.json'):
+            json.dump(results, statsFile, indent=1)
+        else:
+            writer = csv.DictWriter(statsFile, fieldnames=list(results[-1].keys()))
+            writer.writeheader()
+            writer.writerows(results)
 
 # Use the records for the student and the outcomes to generate a report
 # This uses three parts for each email, joined together as a text file.
 # Saluation + Preamble + GeneratedReport + Postamble
+# The email is a greeting, the preamble (--msgA), the report and the
+# postamble (--msgB). The text files are read once and combined into a
+# single template, and each message is filled in from memory:
+#  $first, $name, $section: about the student
+#  $report: the progress report
+#  $mastered, $points: number of mastered outcomes and total mastery points
+# Any other $ in the text files (such as $$ or $20) is kept as it is, so
+# only text spelling one of these placeholders comes out differently from
+# before they existed.
+messagePlaceholders = ['first', 'name', 'section', 'report', 'mastered', 'points']
+messageDollarPattern = re.compile(r'\$(?!(%s)\b|\{(%s)\})' % ('|'.join(messagePlaceholders), '|'.join(messagePlaceholders)))
+def loadMessageText(fileName):
+    with open(fileName,'r') as messageText:
+        return messageDollarPattern.sub('$$', messageText.read())
+
+# The greeting and report use the braced form, so the text around them
+# (say, a postamble starting with a word) never runs into the name.
+# The template is tried out once, so that an email without its report
+# stops the run instead of going to every student.
+def loadMessageTemplate():
+    parts = ['Dear ${first},\n\n']
+    if len(args.msgA) > 0:
+        parts.append(loadMessageText(args.msgA))
+    parts.append('${report}')
+    if len(args.msgB) > 0:
+        parts.append(loadMessageText(args.msgB))
+    template = string.Template(''.join(parts))
+    trial = template.safe_substitute(first='<first>', name='<name>', section='<section>',
+                                     report='<report>', mastered=0, points=0)
+    if not trial.startswith('Dear <first>,') or trial.find('<report>') < 0:
+        raise SystemExit('The message does not come out with the greeting and the report:\n' + trial)
+    return template
+
 def prepareEmail(studentRecord):
     if not studentRecord.hasResults:
         print(studentRecord.name, " (No Results)\n")
         return
     print(studentRecord.name,'\n')
-    with open(args.tempFile, 'w') as messageStream:
-        messageStream.write("Dear %s,\n\n" % (studentRecord.getFirst()))
-        if len(args.msgA) > 0:
-            with open(args.msgA,'r') as messageText:
-                for line in messageText:
-                    messageStream.write(line)
-        generateReport(messageStream, studentRecord)
-        if len(args.msgB) > 0:
-            with open(args.msgB,'r') as messageText:
-                for line in messageText:
-                    messageStream.write(line)
-
-    address = studentRecord.getEmail()
-
-    # Here is the platform specific stuff -- I couldn't get direct Python email
-    # to work, so I used Applescript to send the message to Mail as a draft,
-    # which I could then send. (It is possible to send directly from Applescript,
-    # but that made me nervous.
-    # To send directly, add a line
-    # send
-    # immediately after "set content to msg"
-    mailScript = """
-    set m to POSIX file "%s"
-    set msg to read m
-    tell application "Mail"
-      activate
-      set theOutMessage to make new outgoing message with properties {visible:true}
-      tell theOutMessage
-          make new to recipient at end of to recipients with properties {address:"%s"}
-          set sender to "D. Brian Walton <waltondb@jmu.edu>"
-          set subject to "%s"
-          set content to msg
-      end tell
-    end tell
-    """ % ( os.path.abspath(args.tempFile), address, args.subject )
-    asrun(mailScript.encode())
+    with profiler.timed('report', student=studentRecord.id):
+        reportStream = io.StringIO()
+        numMastered, masteryPoints = generateReport(reportStream, studentRecord)
+        body = messageTemplate.safe_substitute(first=studentRecord.getFirst(),
+                                               name=studentRecord.name,
+                                               section=studentRecord.section,
+                                               report=reportStream.getvalue(),
+                                               mastered=numMastered,
+                                               points=masteryPoints)
+
+    # Hand the message to the delivery backend chosen with --mailer.
+    mailer.submit(studentRecord.getEmail(), args.subject, body)
+
+def addStudent(name, id, emailName, section):
+    studentRecord = StudentRecord(name, id)
+    studentRecord.setEmail(emailName + studentEmailDomain)
+    studentRecord.setSection(section)
+    studentData.append(studentRecord)
+    studentsByID[id] = studentRecord
 
 # Parse the data files to create our desired information
 # Parse the gradebook file that contains names and email-ids (does not have mastery)
+# With --store, both exports were already loaded by mastery-import.py.
 studentData = []
 studentsByID = {}
-with open(args.studentData, newline='') as studentInfoFile:
-    # Create an iterator to go through the rows on the file.
-    dataStream = csv.reader(studentInfoFile)
-
-    # The first row has header information
-    # For this file, we don't have any use for the header information
-    # so that row is always skipped. Can then skip additional rows
-    # using the skipStudents debugging option.
-    headers = next(dataStream)
-    for i in range(1+args.skipStudents):
-        next(dataStream)
-    # Read each student record to identify students and email addresses.
-    for student in dataStream:
-        name = student[0]
-        id = student[1]
-        emailName = student[3]
-        section = student[4]
-        studentRecord = StudentRecord(name, id)
-        studentRecord.setEmail(emailName)
-        studentData.append(studentRecord)
-        studentsByID[id] = studentRecord
-
-# Now parse the mastery report export file.
-# This is going to contain student progress but not email or section information.
-with open(args.masteryData, newline='') as masteryFile:
-    # Create an iterator to go through the rows on the file.
-    dataStream = csv.reader(masteryFile)
-
-    # The first row has header information
-    # Read and then parse this information into something useful for us.
-    # This means identify where objectives are found in the file.
-    # (Canvas creates an unpredictable ordering)
-    headers = next(dataStream)
-    parseMasteryHeader(headers)
-
-    # All other rows are individual student records
-    # Read each row and process into a student progress record
-    for studentRow in dataStream:
-        parseMasteryRow(studentRow)
+store = None
+changedIDs = None
+if args.store != '':
+    store = MasteryStore(args.store, args.snapshot)
+    # The store leaves out the points possible row of the gradebook.
+    for name, id, emailName, section in store.readRoster()[args.skipStudents:]:
+        addStudent(name, id, emailName, section)
+else:
+    with open(args.studentData, newline='') as studentInfoFile:
+        # Create an iterator to go through the rows on the file.
+        dataStream = csv.reader(studentInfoFile)
+
+        # The first row has header information
+        # For this file, we don't have any use for the header information
+        # so that row is always skipped. Can then skip additional rows
+        # using the skipStudents debugging option.
+        headers = next(dataStream)
+        for i in range(1+args.skipStudents):
+            next(dataStream)
+        # Read each student record to identify students and email addresses.
+        for student in dataStream:
+            addStudent(student[0], student[1], student[3], student[4])
+profiler.lap('roster', len(studentData))
 
 # Load the information about which outcomes have been included.
 # Parse the restricted set of outcomes that will be included.
@@ -383,6 +411,56 @@ with open(args.outcomeFile, 'r') as outcomeFile:
         useOutcomes.append(row)
         if len(partialCode) > 0:
             partialOutcomeDict[objCode] = partialCode
+profiler.lap('outcomes', len(useOutcomes))
+
+# Only the columns of included outcomes (and their partial outcomes)
+# are ever read from the mastery export.
+def createScoreMatrix():
+    usedCodes = list(useOutcomeDict.keys()) + list(partialOutcomeDict.values())
+    usedIndices = set([ outcomeDict[code].index for code in usedCodes if code in outcomeDict ])
+    return ScoreMatrix(sorted(usedIndices))
+
+# Now parse the mastery report export file.
+# This is going to contain student progress but not email or section information.
+if store is not None:
+    groups, outcomeArray, outcomeDict = parseOutcomeHeader(store.readMasteryHeader())
+    scoreMatrix = createScoreMatrix()
+    for name, id, row in store.readMasteryRows(scoreMatrix):
+        parseMasteryRow(name, id, row)
+    if args.changedOnly:
+        changedIDs = changedStudents(store.changedOutcomes(), scoreMatrix.outcomeIndices)
+    store.close()
+else:
+    with open(args.masteryData, newline='') as masteryFile:
+        # Create an iterator to go through the rows on the file.
+        dataStream = csv.reader(masteryFile)
+
+        # The first row has header information
+        # Read and then parse this information into something useful for us.
+        # This means identify where objectives are found in the file.
+        # (Canvas creates an unpredictable ordering)
+        headers = next(dataStream)
+        groups, outcomeArray, outcomeDict = parseOutcomeHeader(headers)
+        scoreMatrix = createScoreMatrix()
+
+        # All other rows are individual student records
+        # Read each row and process into a student progress record
+        for name, id, row in readMasteryRows(dataStream, scoreMatrix):
+            parseMasteryRow(name, id, row)
+profiler.lap('mastery', scoreMatrix.numStudents)
+
+# Mastery of every outcome by every student, in one pass over the matrix.
+masteredMask = scoreMatrix.masteryMask()
+
+# Overall statistics for each included outcome: pass/not yet over the class.
+for objCode in outcomeStats:
+    if objCode in outcomeDict:
+        numPassed = scoreMatrix.countColumn(masteredMask, outcomeDict[objCode].index)
+        outcomeStats[objCode] = [numPassed, scoreMatrix.numStudents - numPassed]
+
+# Every report follows the same layout.
+reportPlan = buildReportPlan()
+profiler.lap('mask and plan')
 
 numStudents = len(studentData)
 # Create a sort order for students base on LastName, FirstName
@@ -391,9 +469,33 @@ def nameKey(i):
 nameOrder = sorted([i for i in range(numStudents)], key=nameKey)
 order = nameOrder
 
-if (len(args.summaryReport) > 0):
+# With --changedOnly, leave out the students whose included outcomes are
+# the same as in the previous snapshot of the store.
+if args.changedOnly:
+    if changedIDs is None:
+        print("No previous snapshot to compare with, so every student is included.")
+    else:
+        order = [ i for i in order if studentData[i].id in changedIDs ]
+        print("%d of %d students changed since the previous snapshot." % (len(order), numStudents))
+# With --student, only the students whose name contains the text.
+if args.student != '':
+    order = [ i for i in order if studentData[i].name.lower().find(args.student.lower()) >= 0 ]
+profiler.lap('order', len(order))
+
+if (len(args.stats) > 0):
+    prepareStats()
+    profiler.lap('stats')
+elif (len(args.summaryReport) > 0):
     prepareSummary(order)
+    profiler.lap('summary', len(order))
 else:
+    messageTemplate = loadMessageTemplate()
+    mailer = createBackend(args, args.tempFile, profiler)
     for i in order:
-        if (args.student == '' or studentData[i].name.lower().find(args.student.lower()) >= 0):
-            prepareEmail(studentData[i])
+        prepareEmail(studentData[i])
+    profiler.lap('emails', len(order))
+    # Wait for the last messages and report any that could not be delivered.
+    for address, reason in mailer.close():
+        print('FAILED to send to', address + ':', reason)
+    profiler.lap('mail delivery')
+profiler.close()